@@ -1,36 +1,18 @@
-import time
-import schedule
-from datetime import datetime
 from importlib.machinery import SourceFileLoader
 
 # Загружаем модуль main.py как отдельный модуль
 main_module = SourceFileLoader("main_module", "/home/avito/avito_add_image/main.py").load_module()
-download_xml = main_module.download_xml
-process_xml_with_gdrive = main_module.process_xml_with_gdrive
-
-def job():
-    """Основная функция для запуска процесса обработки"""
-    print(f"Начало обработки: {datetime.now()}")
-    
-    if download_xml():
-        df, file_url = process_xml_with_gdrive()
-        print(f"Ссылка на обработанный документ: {file_url}")
-    print(f"Обработка завершена: {datetime.now()}")
+run_scheduler = main_module.run_scheduler
+# Цикл обработки тот же, что и в main.py: синхронизация таблицы, обработка XML и очистка
+job = main_module.job
 
 def main():
     """Основная функция демона"""
     print("Демон запущен...")
     
-    # Запускаем задачу сразу при старте
-    job()
-    
-    # Планируем выполнение каждые 5 минут
-    schedule.every(5).minutes.do(job)
-    
-    # Бесконечный цикл для выполнения запланированных задач
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    # Запускаем задачу сразу при старте и далее регулярно (базовый интервал - 5 минут,
+    # без изменений интервал увеличивается; циклы не перекрываются)
+    run_scheduler(job)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
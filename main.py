@@ -1,28 +1,85 @@
 import os
 import time
+import math
 import xml.etree.ElementTree as ET
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image as PILImage
 import pandas as pd
+import numpy as np
 from io import BytesIO
-from urllib.parse import urlparse
-from datetime import datetime
-import schedule
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
+try:
+    import fcntl  # Файловая блокировка между процессами (нет в Windows)
+except ImportError:
+    fcntl = None
+try:
+    import aiohttp  # Асинхронный HTTP-клиент для конвейера IMAGE_PIPELINE = "async"
+except ImportError:
+    aiohttp = None
 from google.oauth2 import service_account
+from google.auth.transport.requests import Request as GoogleAuthRequest
+import google_auth_httplib2
+import httplib2
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import HttpRequest, MediaFileUpload, MediaIoBaseUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
 import openpyxl
 from openpyxl.drawing.image import Image
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 from pathlib import Path
 import uuid
+import threading
+import multiprocessing
+import sqlite3
+import hashlib
+import shutil
+import json
+import asyncio
+from collections import OrderedDict, deque
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Конфигурация
 XML_URL = "https://baz-on.ru/export/c4447/32a54/avito-ipkuznetsov.xml"
 LOCAL_XML_PATH = "avito-ipkuznetsov.xml"
+FEED_META_PATH = f"{LOCAL_XML_PATH}.meta.json"  # ETag/Last-Modified и хеши XML-файла
 OUTPUT_EXCEL_PATH = "avito_processed.xlsx"
 GOOGLE_CRED_PATH = "google_cred.json"
 MAX_ITEMS = 99999 # Ограничиваем для демонстрации
+CYCLE_INTERVAL_MINUTES = 5  # Интервал между циклами обработки
+CYCLE_INTERVAL_MAX_MINUTES = 30  # Максимальный интервал, если XML-файл долго не меняется
+CYCLE_BACKOFF_FACTOR = 2  # Во сколько раз растет интервал после цикла без изменений
+CYCLE_LOCK_PATH = "avito_cycle.lock"  # Файловая блокировка: один цикл обработки на все процессы
+# Товары, изображения которых не удалось получить, повторно обрабатываются при неизменном XML
+# не чаще этого интервала (при изменении XML - в ближайшем цикле)
+IMAGE_RETRY_INTERVAL_MINUTES = 60
 IMAGES_FOLDER_NAME = "avito_images"  # Название папки для изображений на Google Drive
+PRODUCTS_DB = "products.sqlite"  # Локальное хранилище товаров; Excel-таблица - выгрузка из него
+FINGERPRINTS_PATH = "ad_fingerprints.json"  # Отпечатки прежних версий (переносятся в хранилище)
+DRIVE_STATE_PATH = "drive_state.json"  # Сохраненные между запусками ID папок и файлов на Google Drive
+DRIVE_BATCH_SIZE = 100  # Максимум вызовов в одном пакетном запросе Google Drive API
+DRIVE_FILE_VERSION_FIELDS = ('md5Checksum', 'modifiedTime', 'version')  # По ним определяем изменения файла на Google Drive
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+DRIVE_TOKEN_REFRESH_MARGIN = 300  # Токен доступа обновляется заранее, за 5 минут до истечения
+DRIVE_HTTP_TIMEOUT = 120  # Таймаут запросов к Google Drive API, секунды
+# Файлы до этого размера загружаются одним multipart-запросом, крупнее - возобновляемой загрузкой
+DRIVE_MULTIPART_THRESHOLD = 5 * 1024 * 1024
+DRIVE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Размер части возобновляемой загрузки (кратен 256 КБ)
+DRIVE_UPLOAD_SESSION_TTL = 6 * 24 * 3600  # Сессии возобновляемой загрузки живут неделю, храним чуть меньше
+
+# Список стандартных параметров, которые всегда должны быть.
+# В этом порядке они идут первыми столбцами Excel-таблицы
+STANDARD_PARAMETERS = [
+    "Id", "AdType", "Category", "Address", "ContactPhone", 
+    "GoodsType", "ProductType", "SparePartType", "Title", 
+    "Description", "Price", "Availability", "Condition", "Brand", "OEM",
+    "TechnicSparePartType", "TransmissionSparePartType", "EngineSparePartType"
+]
 
 # Новый текст описания
 NEW_DESCRIPTION = """</p><p><strong>Автозапчасти на Волнянского</strong> - более 10 000 в наличии + любые под заказ. Оригинальные и проверенные аналоги!</p>
@@ -39,6 +96,60 @@ OVERLAY_IMAGES = [
     "images/4.png"
 ]
 
+# Максимальное количество масштабированных оверлеев в кэше (LRU)
+OVERLAY_CACHE_MAX_ITEMS = 32
+
+# Параметры параллельной обработки изображений
+IO_WORKERS = 8  # Потоки для скачивания изображений и загрузки на Google Drive
+RENDER_WORKERS = os.cpu_count() or 2  # Процессы для наложения изображений (PIL)
+AD_WORKERS = 4  # Количество объявлений, обрабатываемых одновременно
+# Конвейер изображений: "threads" - каждое изображение обрабатывается задачей в пуле IO_WORKERS;
+# "async" - скачивание идет в цикле событий asyncio (aiohttp), наложение и загрузка на Google Drive -
+# в пулах, поэтому одновременно скачиваются сотни и тысячи изображений
+IMAGE_PIPELINE = "threads"
+ASYNC_FETCH_CONCURRENCY = 1000  # Максимум одновременных скачиваний в асинхронном конвейере
+ASYNC_CONNECTIONS_PER_HOST = 100  # Максимум одновременных соединений с одним хостом
+ASYNC_DRIVE_CONCURRENCY = IO_WORKERS  # Максимум одновременных загрузок на Google Drive
+# Объявлений в работе одновременно: ограничивает память под скачанные, но еще не обработанные фото
+ASYNC_AD_WINDOW = 100
+
+# Параметры HTTP-клиента для скачивания изображений поставщика
+HTTP_POOL_MAXSIZE = 8  # Максимум одновременных соединений с одним хостом
+HTTP_TIMEOUT = (10, 60)  # Таймауты (подключение, чтение) в секундах
+HTTP_RETRIES = 3  # Количество повторных попыток при сетевых ошибках и кодах 429/5xx
+HTTP_BACKOFF = 1  # Множитель экспоненциальной задержки между попытками (1, 2, 4... секунд)
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)  # Коды ответа, при которых запрос повторяется
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Размер части при потоковом скачивании изображений в файл
+
+# Кэш обработанных изображений: индекс SQLite и каталог с JPEG-файлами по хешу содержимого
+IMAGE_CACHE_DB = "image_cache.sqlite"
+IMAGE_CACHE_DIR = "image_cache"
+RENDER_VERSION = 3  # Увеличивается при изменении алгоритма наложения, чтобы сбросить кэш
+# При загрузке на Google Drive обработанные изображения кодируются в память и загружаются
+# без чтения с диска; копия в processed_images и кэше сохраняется, только если включено
+IMAGE_WRITE_THROUGH = True
+
+# Очистка устаревших файлов: processed_images, кэш изображений и папка изображений на Google Drive
+GC_INTERVAL_HOURS = 24  # Очистка выполняется не чаще раза в сутки, после цикла обработки
+GC_MAX_AGE_DAYS = 30  # Неиспользуемые локальные копии и записи кэша старше этого срока удаляются
+GC_MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # Бюджет размера кэша изображений на диске
+GC_DRIVE_GRACE_HOURS = 24  # Файлы на Google Drive моложе этого срока не удаляются (могут быть еще не записаны в таблицу)
+GC_TMP_MAX_AGE = 3600  # Временные файлы прерванных записей удаляются через час, секунды
+
+# Профиль JPEG-кодировщика для обработанных изображений (параметры PIL для формата JPEG).
+# progressive дает файлы меньше примерно на 5%, optimize - на 1%, но кодирование
+# становится в 2-5 раз дольше, поэтому по умолчанию они выключены
+JPEG_PROFILE = {
+    "quality": 75,
+    "progressive": False,
+    "subsampling": "4:2:0",
+    "optimize": False,
+}
+JPEG_MAX_DIMENSION = 1920  # Максимальная сторона итогового изображения, px; крупнее Авито все равно уменьшит
+JPEG_MAX_BYTES = 1024 * 1024  # Бюджет размера одного изображения: при превышении снижаем качество
+JPEG_MIN_QUALITY = 60  # Ниже этого качества не опускаемся, даже если бюджет превышен
+JPEG_QUALITY_STEP = 10
+
 # Путь к изображению для наложения водяного знака
 WATERMARK_PATH = "images/1.png"
 
@@ -49,13 +160,40 @@ SHOP_IMAGES = [
     "shop/photo_7_2025-04-10_16-52-54.jpg"
 ]
 
+def load_feed_meta():
+    """Загружает метаданные XML-файла: ETag, Last-Modified, хеш содержимого и хеш последней обработки"""
+    if not os.path.exists(FEED_META_PATH):
+        return {}
+    try:
+        with open(FEED_META_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Не удалось прочитать {FEED_META_PATH}: {e}")
+        return {}
+
+def save_feed_meta(meta):
+    """Атомарно сохраняет метаданные XML-файла"""
+    tmp_path = f"{FEED_META_PATH}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, FEED_META_PATH)
+    except Exception as e:
+        print(f"Не удалось сохранить {FEED_META_PATH}: {e}")
+
 def download_xml(max_retries=5, retry_delay=10):
     """
     Загрузка XML-файла с сервера с поддержкой повторных попыток
     
+    Используется условный запрос (If-None-Match / If-Modified-Since) и сжатие gzip:
+    если файл на сервере не изменился, он не скачивается и не перезаписывается.
+    
     max_retries: максимальное количество попыток
     retry_delay: задержка между попытками в секундах
     """
+    meta = load_feed_meta()
+    has_local_copy = os.path.exists(LOCAL_XML_PATH)
+    
     for attempt in range(1, max_retries + 1):
         try:
             # Добавляем случайный User-Agent, чтобы избежать блокировки
@@ -63,16 +201,38 @@ def download_xml(max_retries=5, retry_delay=10):
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
                 'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
                 'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
+                'Accept-Encoding': 'gzip, deflate',
                 'Connection': 'keep-alive'
             }
             
+            # Условный запрос возможен, только если локальная копия на месте
+            if has_local_copy:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+            
             print(f"Попытка {attempt} из {max_retries} загрузить XML-файл...")
             response = requests.get(XML_URL, headers=headers, timeout=60)
             
-            if response.status_code == 200:
-                with open(LOCAL_XML_PATH, 'wb') as f:
-                    f.write(response.content)
-                print(f"XML-файл загружен: {LOCAL_XML_PATH}")
+            if response.status_code == 304:
+                print(f"XML-файл на сервере не изменился, используем {LOCAL_XML_PATH}")
+                return True
+            elif response.status_code == 200:
+                content_hash = hashlib.sha256(response.content).hexdigest()
+                if has_local_copy and content_hash == meta.get('sha256'):
+                    print(f"Содержимое XML-файла не изменилось, используем {LOCAL_XML_PATH}")
+                else:
+                    tmp_path = f"{LOCAL_XML_PATH}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(response.content)
+                    os.replace(tmp_path, LOCAL_XML_PATH)
+                    print(f"XML-файл загружен: {LOCAL_XML_PATH}")
+                
+                meta['etag'] = response.headers.get('ETag')
+                meta['last_modified'] = response.headers.get('Last-Modified')
+                meta['sha256'] = content_hash
+                save_feed_meta(meta)
                 return True
             elif response.status_code == 429:
                 # Если сервер вернул 429, ждем дольше
@@ -101,6 +261,34 @@ def download_xml(max_retries=5, retry_delay=10):
     
     return False
 
+def _processing_signature():
+    """Хеш XML-файла и Excel-таблицы: определяет, нужна ли очередная обработка"""
+    feed_hash = file_digest(LOCAL_XML_PATH) if os.path.exists(LOCAL_XML_PATH) else ""
+    excel_hash = file_digest(OUTPUT_EXCEL_PATH) if os.path.exists(OUTPUT_EXCEL_PATH) else ""
+    return f"{feed_hash}:{excel_hash}"
+
+def feed_needs_processing():
+    """
+    Проверяет, изменились ли XML-файл или Excel-таблица с последней успешной обработки
+    и осталась ли незавершенная работа: товары без изображений или изменения таблицы,
+    не загруженные на Google Drive. Если нет, цикл обработки можно пропустить целиком.
+    """
+    if load_feed_meta().get('processed_signature') != _processing_signature():
+        return True
+    if product_store_image_retry_due():
+        print("В таблице есть товары без изображений, пора повторить их обработку")
+        return True
+    if any(product_store_pending_changes().values()):
+        print("Изменения таблицы еще не загружены на Google Drive, повторяем обработку")
+        return True
+    return False
+
+def mark_feed_processed():
+    """Запоминает состояние XML-файла и таблицы после успешной обработки"""
+    meta = load_feed_meta()
+    meta['processed_signature'] = _processing_signature()
+    save_feed_meta(meta)
+
 def create_output_dir():
     """Создание директории для обработанных изображений"""
     output_dir = "processed_images"
@@ -108,71 +296,561 @@ def create_output_dir():
         os.makedirs(output_dir)
     return output_dir
 
-def overlay_image(base_image_url, overlay_path, output_path):
-    """Наложение одного изображения на другое с сохранением соотношения сторон"""
+# Кэш оверлеев: декодированные исходники и масштабированные версии по (путь, размер)
+_overlay_sources = {}
+_overlay_cache = OrderedDict()
+_overlay_cache_lock = threading.Lock()
+
+def load_overlay_source(overlay_path):
+    """Декодирует PNG-оверлей в RGBA один раз за время работы процесса"""
+    with _overlay_cache_lock:
+        overlay_img = _overlay_sources.get(overlay_path)
+        if overlay_img is None:
+            with PILImage.open(overlay_path) as src:
+                overlay_img = src.convert("RGBA")
+            _overlay_sources[overlay_path] = overlay_img
+        return overlay_img
+
+def get_scaled_overlay(overlay_path, base_size):
+    """
+    Возвращает оверлей, вписанный в base_size с сохранением соотношения сторон.
+    Результат кэшируется по (путь оверлея, целевой размер) с вытеснением LRU.
+    """
+    overlay_img = load_overlay_source(overlay_path)
+    
+    base_width, base_height = base_size
+    overlay_width, overlay_height = overlay_img.size
+    ratio = min(base_width / overlay_width, base_height / overlay_height)
+    target_size = (int(overlay_width * ratio), int(overlay_height * ratio))
+    key = (overlay_path, target_size)
+    
+    cached = _overlay_cache_get(key)
+    if cached is not None:
+        return cached
+    
+    scaled = overlay_img.resize(target_size, PILImage.LANCZOS)
+    _overlay_cache_put(key, scaled)
+    return scaled
+
+def _overlay_cache_get(key):
+    """Значение из LRU-кэша оверлеев или None"""
+    with _overlay_cache_lock:
+        cached = _overlay_cache.get(key)
+        if cached is not None:
+            _overlay_cache.move_to_end(key)
+        return cached
+
+def _overlay_cache_put(key, value):
+    """Кладет значение в LRU-кэш оверлеев, вытесняя самые старые записи"""
+    with _overlay_cache_lock:
+        _overlay_cache[key] = value
+        _overlay_cache.move_to_end(key)
+        while len(_overlay_cache) > OVERLAY_CACHE_MAX_ITEMS:
+            _overlay_cache.popitem(last=False)
+
+def get_overlay_layers(overlay_path, base_size):
+    """
+    Возвращает оверлей, подготовленный для смешивания в NumPy (кэшируется так же,
+    как масштабированный оверлей): (размер оверлея, прямоугольник с непрозрачными
+    пикселями, цвета, предумноженные на альфу (uint16), и обратная альфа 255 - a (uint16)).
+    Смешиваются только пиксели внутри прямоугольника
+    """
+    scaled = get_scaled_overlay(overlay_path, base_size)
+    key = (overlay_path, scaled.size, "layers")
+    cached = _overlay_cache_get(key)
+    if cached is not None:
+        return cached
+    
+    bbox = scaled.getchannel("A").getbbox() or (0, 0, 0, 0)
+    pixels = np.asarray(scaled.crop(bbox), dtype=np.uint16)
+    alpha = pixels[..., 3:4]
+    layers = (scaled.size, bbox, pixels[..., :3] * alpha, 255 - alpha)
+    _overlay_cache_put(key, layers)
+    return layers
+
+def apply_overlay(base_img, overlay_path):
+    """
+    Накладывает оверлей внизу RGB-изображения (по центру, с отступом 0.5% высоты).
+    Изображение изменяется на месте: смешивается только прямоугольник с непрозрачными
+    пикселями оверлея. Результат попиксельно совпадает с Image.paste с маской
+    (формула Pillow: (base * (255 - a) + overlay * a) / 255 с округлением DIV255)
+    """
+    # Получаем размеры базового изображения
+    base_width, base_height = base_img.size
+    
+    # Оверлей, уже масштабированный под размер базового изображения (из кэша)
+    (new_overlay_width, new_overlay_height), bbox, premultiplied, inverse_alpha = \
+        get_overlay_layers(overlay_path, base_img.size)
+    
+    # Вычисляем позицию для размещения наложения внизу изображения
+    # Горизонтально центрируем, а вертикально смещаем вниз
+    paste_x = (base_width - new_overlay_width) // 2
+    
+    # Минимальный отступ от нижнего края - всего 0.5% высоты (уменьшено с 2%)
+    bottom_margin = int(base_height * 0.005)  # 0.5% от высоты для минимального отступа снизу
+    paste_y = base_height - new_overlay_height - bottom_margin
+    
+    # Проверка, чтобы изображение не вышло за пределы
+    if paste_y < 0:
+        paste_y = 0
+    
+    if premultiplied.size == 0:
+        return base_img  # Оверлей полностью прозрачный
+    
+    # Смешиваем только область оверлея с непрозрачными пикселями
+    box = (paste_x + bbox[0], paste_y + bbox[1], paste_x + bbox[2], paste_y + bbox[3])
+    region = np.asarray(base_img.crop(box), dtype=np.uint16)
+    blended = region * inverse_alpha + premultiplied + 128
+    blended = ((blended + (blended >> 8)) >> 8).astype(np.uint8)
+    base_img.paste(PILImage.fromarray(blended, "RGB"), box[:2])
+    return base_img
+
+def warm_overlay_cache(overlay_paths=None):
+    """Предварительно декодирует все оверлеи из OVERLAY_IMAGES"""
+    for overlay_path in overlay_paths or OVERLAY_IMAGES:
+        try:
+            load_overlay_source(overlay_path)
+        except Exception as e:
+            print(f"Не удалось загрузить оверлей {overlay_path}: {e}")
+
+# Общая HTTP-сессия с пулом keep-alive соединений (создается при первом обращении)
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """
+    Возвращает общую для всех потоков HTTP-сессию: соединения переиспользуются,
+    количество соединений с одним хостом ограничено HTTP_POOL_MAXSIZE,
+    ошибки соединения и ответы 429/5xx повторяются с экспоненциальной задержкой
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=HTTP_RETRY_STATUSES,
+                allowed_methods=frozenset(["GET", "HEAD"]),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                pool_block=True,
+                max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+def fetch_image_bytes(image_url):
+    """Скачивает изображение и возвращает его содержимое (bytes) или None"""
     try:
-        # Загрузка базового изображения
-        response = requests.get(base_image_url)
+        response = get_http_session().get(image_url, timeout=HTTP_TIMEOUT)
         if response.status_code != 200:
-            print(f"Ошибка загрузки изображения {base_image_url}, код: {response.status_code}")
+            print(f"Ошибка загрузки изображения {image_url}, код: {response.status_code}")
             return None
+        return response.content
+    except Exception as e:
+        print(f"Ошибка при скачивании изображения {image_url}: {e}")
+        return None
+
+def fetch_image_conditional(image_url, etag=None, last_modified=None):
+    """
+    Условное скачивание изображения (If-None-Match / If-Modified-Since).
+    
+    Возвращает кортеж (содержимое, etag, last_modified, not_modified):
+    при ответе 304 содержимое равно None, а not_modified - True;
+    при ошибке возвращается (None, None, None, False).
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        response = get_http_session().get(image_url, headers=headers, timeout=HTTP_TIMEOUT)
+        if response.status_code == 304:
+            return None, etag, last_modified, True
+        if response.status_code != 200:
+            print(f"Ошибка загрузки изображения {image_url}, код: {response.status_code}")
+            return None, None, None, False
+        return (
+            response.content,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            False
+        )
+    except Exception as e:
+        print(f"Ошибка при скачивании изображения {image_url}: {e}")
+        return None, None, None, False
+
+def fetch_image_to_file(image_url, output_path, etag=None, last_modified=None):
+    """
+    Условное скачивание изображения потоком прямо в файл: содержимое пишется
+    частями во временный файл рядом с output_path (с подсчетом SHA-256 на лету)
+    и атомарно переименовывается, поэтому расход памяти не зависит от размера фото.
+    
+    Возвращает кортеж (путь к временному файлу, хеш содержимого, etag, last_modified, not_modified):
+    временный файл нужно переименовать или удалить вызывающему коду;
+    при ответе 304 путь и хеш равны None, а not_modified - True;
+    при ошибке возвращается (None, None, None, None, False).
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with get_http_session().get(image_url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as response:
+            if response.status_code == 304:
+                return None, None, etag, last_modified, True
+            if response.status_code != 200:
+                print(f"Ошибка загрузки изображения {image_url}, код: {response.status_code}")
+                return None, None, None, None, False
             
-        base_img = PILImage.open(BytesIO(response.content)).convert("RGBA")
-        
-        # Открытие изображения для наложения и конвертация в RGBA
-        overlay_img = PILImage.open(overlay_path).convert("RGBA")
-        
-        # Получаем размеры базового изображения
-        base_width, base_height = base_img.size
-        
-        # Изменяем размер наложения, сохраняя соотношение сторон
-        overlay_width, overlay_height = overlay_img.size
-        ratio = min(base_width / overlay_width, base_height / overlay_height)
-        new_overlay_width = int(overlay_width * ratio)
-        new_overlay_height = int(overlay_height * ratio)
-        
-        # Изменение размера наложения с сохранением соотношения сторон
-        overlay_img = overlay_img.resize((new_overlay_width, new_overlay_height), PILImage.LANCZOS)
-        
-        # Вычисляем позицию для размещения наложения внизу изображения
-        # Горизонтально центрируем, а вертикально смещаем вниз
-        paste_x = (base_width - new_overlay_width) // 2
-        
-        # Минимальный отступ от нижнего края - всего 0.5% высоты (уменьшено с 2%)
-        bottom_margin = int(base_height * 0.005)  # 0.5% от высоты для минимального отступа снизу
-        paste_y = base_height - new_overlay_height - bottom_margin
-        
-        # Проверка, чтобы изображение не вышло за пределы
-        if paste_y < 0:
-            paste_y = 0
-        
-        # Создаем новое изображение с правильными каналами и прозрачностью
-        result = PILImage.new("RGBA", base_img.size, (0, 0, 0, 0))
-        result.paste(base_img, (0, 0))
-        result.paste(overlay_img, (paste_x, paste_y), overlay_img)
+            digest = hashlib.sha256()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        digest.update(chunk)
+                        f.write(chunk)
+            return (
+                tmp_path,
+                digest.hexdigest(),
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified'),
+                False
+            )
+    except Exception as e:
+        print(f"Ошибка при скачивании изображения {image_url}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, None, None, None, False
+
+async def fetch_image_async(session, image_url, output_path=None, etag=None, last_modified=None):
+    """
+    Асинхронное условное скачивание изображения через aiohttp: без output_path
+    содержимое возвращается в памяти (как fetch_image_conditional), с output_path -
+    пишется частями во временный файл (как fetch_image_to_file).
+    Ошибки соединения и ответы HTTP_RETRY_STATUSES повторяются с экспоненциальной задержкой.
+
+    Возвращает кортеж (содержимое, путь к временному файлу, хеш содержимого, etag, last_modified, not_modified);
+    при ответе 304 not_modified - True, при ошибке возвращается (None, None, None, None, None, False).
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    for attempt in range(HTTP_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(HTTP_BACKOFF * 2 ** (attempt - 1))
+        tmp_path = None
+        try:
+            async with session.get(image_url, headers=headers) as response:
+                if response.status == 304:
+                    return None, None, None, etag, last_modified, True
+                if response.status in HTTP_RETRY_STATUSES and attempt < HTTP_RETRIES:
+                    continue
+                if response.status != 200:
+                    print(f"Ошибка загрузки изображения {image_url}, код: {response.status}")
+                    return None, None, None, None, None, False
+
+                new_etag = response.headers.get('ETag')
+                new_last_modified = response.headers.get('Last-Modified')
+                if output_path is None:
+                    image_bytes = await response.read()
+                    return (image_bytes, None, hashlib.sha256(image_bytes).hexdigest(),
+                            new_etag, new_last_modified, False)
+
+                # Части небольшие, запись в файл почти не задерживает цикл событий
+                digest = hashlib.sha256()
+                tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+                return None, tmp_path, digest.hexdigest(), new_etag, new_last_modified, False
+        except Exception as e:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)) and attempt < HTTP_RETRIES:
+                continue
+            print(f"Ошибка при скачивании изображения {image_url}: {e}")
+            return None, None, None, None, None, False
+
+def link_or_copy(src_path, dst_path):
+    """
+    Создает dst_path как жесткую ссылку на src_path (без копирования данных);
+    если это невозможно (другая файловая система), копирует файл средствами ядра
+    (shutil.copyfile использует sendfile). Запись идет через временный файл с атомарной заменой
+    """
+    tmp_path = f"{dst_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+def write_file_atomic(file_path, data):
+    """
+    Записывает данные через временный файл с атомарной заменой: файл на месте
+    может быть жесткой ссылкой на файл из кэша, который нельзя менять
+    """
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+def same_file(first_path, second_path):
+    """Проверяет, что оба пути указывают на один и тот же файл (жесткая ссылка)"""
+    try:
+        return os.path.samefile(first_path, second_path)
+    except OSError:
+        return False
+
+# Подключение к индексу кэша обработанных изображений (одно на процесс, под блокировкой)
+_image_cache_conn = None
+_image_cache_lock = threading.Lock()
+_asset_hashes = {}
+
+def _image_cache_db():
+    """Открывает (и при необходимости создает) индекс кэша обработанных изображений"""
+    global _image_cache_conn
+    if _image_cache_conn is None:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(IMAGE_CACHE_DB, check_same_thread=False)
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS images (
+                cache_key TEXT PRIMARY KEY,
+                source_url TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                asset_hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                source_hash TEXT,
+                blob TEXT,
+                drive_url TEXT,
+                updated_at REAL
+            )"""
+        )
+        conn.commit()
+        _image_cache_conn = conn
+    return _image_cache_conn
+
+def file_digest(file_path, algorithm="sha256"):
+    """Хеш содержимого файла (по умолчанию SHA-256, algorithm - любой алгоритм hashlib)"""
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def asset_hash(asset_path):
+    """
+    Хеш файла оверлея или изображения магазина. Пересчитывается только
+    при изменении размера или времени модификации файла.
+    """
+    if not asset_path:
+        return ""
+    stat = os.stat(asset_path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    with _image_cache_lock:
+        cached = _asset_hashes.get(asset_path)
+    if cached is None or cached[0] != signature:
+        cached = (signature, file_digest(asset_path))
+        with _image_cache_lock:
+            _asset_hashes[asset_path] = cached
+    return cached[1]
+
+def encoder_settings_hash():
+    """Хеш настроек JPEG-кодировщика: при их изменении обработанные изображения кэша устаревают"""
+    settings = {
+        "profile": JPEG_PROFILE,
+        "max_dimension": JPEG_MAX_DIMENSION,
+        "max_bytes": JPEG_MAX_BYTES,
+        "min_quality": JPEG_MIN_QUALITY,
+        "quality_step": JPEG_QUALITY_STEP,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def image_cache_key(source_url, slot, asset_digest):
+    """
+    Ключ кэша: исходный URL, номер слота, хеш оверлея, версия алгоритма наложения
+    и (для обрабатываемых изображений) хеш настроек JPEG-кодировщика
+    """
+    raw = f"{source_url}|{slot}|{asset_digest}|{RENDER_VERSION}"
+    if asset_digest:
+        # Изображения без обработки сохраняются как есть и от настроек кодировщика не зависят
+        raw += f"|{encoder_settings_hash()}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def image_cache_blob_path(blob):
+    """Путь к файлу в кэше по хешу его содержимого"""
+    return os.path.join(IMAGE_CACHE_DIR, blob[:2], f"{blob}.jpg")
+
+def image_cache_get(cache_key):
+    """Возвращает запись кэша (dict) или None, если записи нет или файл кэша утерян"""
+    with _image_cache_lock:
+        row = _image_cache_db().execute(
+            "SELECT etag, last_modified, source_hash, blob, drive_url FROM images WHERE cache_key = ?",
+            (cache_key,)
+        ).fetchone()
+    if row is None:
+        return None
+    entry = dict(zip(("etag", "last_modified", "source_hash", "blob", "drive_url"), row))
+    if entry["blob"]:
+        if not os.path.exists(image_cache_blob_path(entry["blob"])):
+            return None
+    elif not entry["drive_url"]:
+        # Изображение без копии на диске годится только вместе со ссылкой Google Drive
+        return None
+    return entry
+
+def image_cache_put(cache_key, source_url, slot, asset_digest, etag, last_modified, source_hash, blob, drive_url=None):
+    """Сохраняет или обновляет запись кэша"""
+    with _image_cache_lock:
+        conn = _image_cache_db()
+        conn.execute(
+            """INSERT OR REPLACE INTO images
+               (cache_key, source_url, slot, asset_hash, etag, last_modified, source_hash, blob, drive_url, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (cache_key, source_url, slot, asset_digest, etag, last_modified, source_hash, blob, drive_url, time.time())
+        )
+        conn.commit()
+
+def image_cache_set_drive_url(cache_key, drive_url):
+    """Запоминает ссылку Google Drive для закэшированного изображения"""
+    with _image_cache_lock:
+        conn = _image_cache_db()
+        conn.execute(
+            "UPDATE images SET drive_url = ?, updated_at = ? WHERE cache_key = ?",
+            (drive_url, time.time(), cache_key)
+        )
+        conn.commit()
+
+def image_cache_add_blob(file_path, blob=None):
+    """
+    Добавляет файл в кэш под именем хеша его содержимого и возвращает хеш.
+    blob - уже известный хеш содержимого (чтобы не читать файл повторно)
+    """
+    blob = blob or file_digest(file_path)
+    blob_path = image_cache_blob_path(blob)
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        link_or_copy(file_path, blob_path)
+    return blob
+
+def image_cache_add_bytes(data):
+    """Сохраняет содержимое из памяти в кэш под именем его хеша и возвращает хеш"""
+    blob = hashlib.sha256(data).hexdigest()
+    blob_path = image_cache_blob_path(blob)
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        write_file_atomic(blob_path, data)
+    return blob
+
+def materialize_cached_image(blob, output_path):
+    """Восстанавливает файл из кэша по пути output_path (если он уже там - ничего не пишет)"""
+    blob_path = image_cache_blob_path(blob)
+    if same_file(blob_path, output_path):
+        return output_path
+    return link_or_copy(blob_path, output_path)
+
+def fit_within(image, max_width, max_height):
+    """Уменьшает изображение (с сохранением пропорций), чтобы оно помещалось в max_width x max_height"""
+    width, height = image.size
+    scale = min(1, max_width / width, max_height / height)
+    if scale >= 1:
+        return image
+    new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return image.resize(new_size, PILImage.LANCZOS)
+
+def fit_max_dimension(image, max_dimension=JPEG_MAX_DIMENSION):
+    """Уменьшает изображение, чтобы большая сторона не превышала max_dimension"""
+    if not max_dimension:
+        return image
+    return fit_within(image, max_dimension, max_dimension)
+
+def decode_for_render(image_bytes, mode, max_width=None, max_height=None):
+    """
+    Декодирует скачанное изображение сразу в нужном для рендеринга размере.
+    JPEG, который заметно больше max_width x max_height, декодируется в режиме
+    draft: масштабирование в 2/4/8 раз выполняется в DCT при распаковке, что
+    в разы быстрее и требует меньше памяти, чем полное декодирование. Затем
+    изображение точно уменьшается до нужного размера
+    """
+    image = PILImage.open(BytesIO(image_bytes))
+    if max_width and max_height and image.format == "JPEG":
+        scale = min(1, max_width / image.width, max_height / image.height)
+        if scale < 1:
+            # draft выбирает наименьший масштаб, при котором размер не меньше запрошенного
+            image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    image = image.convert(mode)
+    if max_width and max_height:
+        image = fit_within(image, max_width, max_height)
+    return image
+
+def save_jpeg(image, output_path=None):
+    """
+    Сохраняет изображение в JPEG по профилю JPEG_PROFILE. Если файл не укладывается
+    в JPEG_MAX_BYTES, качество снижается шагами JPEG_QUALITY_STEP до JPEG_MIN_QUALITY.
+    Без output_path возвращает закодированные байты вместо записи на диск
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image = fit_max_dimension(image)
+    quality = JPEG_PROFILE.get("quality", 75)
+    while True:
+        buffer = BytesIO()
+        image.save(buffer, "JPEG", **{**JPEG_PROFILE, "quality": quality})
+        if buffer.tell() <= JPEG_MAX_BYTES or quality - JPEG_QUALITY_STEP < JPEG_MIN_QUALITY:
+            break
+        quality -= JPEG_QUALITY_STEP
+    if output_path is None:
+        return buffer.getvalue()
+    return write_file_atomic(output_path, buffer.getbuffer())
+
+def render_overlay(image_bytes, overlay_path, output_path=None):
+    """
+    Наложение оверлея на уже скачанное изображение с сохранением соотношения сторон.
+    Возвращает путь к сохраненному файлу или JPEG-байты, если output_path не задан
+    """
+    try:
+        # Сразу декодируем в итоговом размере: оверлей масштабируется под базовое изображение,
+        # поэтому накладывать его на полноразмерное фото, а затем уменьшать, незачем
+        base_img = decode_for_render(image_bytes, "RGB", JPEG_MAX_DIMENSION, JPEG_MAX_DIMENSION)
         
-        # Конвертация в RGB для сохранения в JPEG
-        result = result.convert("RGB")
+        # Накладываем оверлей прямо на RGB-изображение, без промежуточных полноразмерных копий
+        result = apply_overlay(base_img, overlay_path)
         
-        # Сохранение результата
-        result.save(output_path)
-        return output_path
+        # Сохранение результата в JPEG по профилю кодировщика
+        return save_jpeg(result, output_path)
     except Exception as e:
         print(f"Ошибка при наложении изображения: {e}")
         import traceback
         traceback.print_exc()
         return None
 
-def add_shop_image(base_image_url, shop_image_path, output_path):
-    """Добавляет изображение магазина к первому изображению товара в виде коллажа"""
+def render_shop_collage(image_bytes, shop_image_path, output_path=None):
+    """
+    Собирает коллаж из уже скачанного изображения товара и изображения магазина.
+    Возвращает путь к сохраненному файлу или JPEG-байты, если output_path не задан
+    """
     try:
-        # Загрузка базового изображения товара
-        response = requests.get(base_image_url)
-        if response.status_code != 200:
-            print(f"Ошибка загрузки изображения {base_image_url}, код: {response.status_code}")
-            return None
-            
-        base_img = PILImage.open(BytesIO(response.content)).convert("RGB")
+        # Коллаж вдвое шире базового изображения: декодируем базовое изображение сразу
+        # уменьшенным, чтобы готовый коллаж укладывался в JPEG_MAX_DIMENSION
+        if JPEG_MAX_DIMENSION:
+            base_img = decode_for_render(image_bytes, "RGB", (JPEG_MAX_DIMENSION - 20) // 2, JPEG_MAX_DIMENSION)
+        else:
+            base_img = decode_for_render(image_bytes, "RGB")
         
         # Открытие изображения магазина
         shop_img = PILImage.open(shop_image_path).convert("RGB")
@@ -201,143 +879,628 @@ def add_shop_image(base_image_url, shop_image_path, output_path):
         # Размещаем изображение магазина справа
         collage.paste(shop_img, (base_width + 20, 0))
         
-        # Сохраняем результат
-        collage.save(output_path)
-        return output_path
+        # Сохраняем результат (коллаж шире JPEG_MAX_DIMENSION будет уменьшен)
+        return save_jpeg(collage, output_path)
     except Exception as e:
         print(f"Ошибка при создании коллажа: {e}")
         import traceback
         traceback.print_exc()
         return None
 
-def upload_image_to_gdrive(drive_service, file_path, max_retries=3, retry_delay=5):
+def overlay_image(base_image_url, overlay_path, output_path=None):
     """
-    Загружает изображение на Google Drive и возвращает публичную ссылку
-    
-    drive_service: Инициализированный сервис Google Drive API
-    file_path: Путь к локальному файлу
-    max_retries: Максимальное количество попыток загрузки
-    retry_delay: Задержка между попытками в секундах
-    
-    Возвращает: публичную ссылку на изображение
+    Наложение одного изображения на другое с сохранением соотношения сторон.
+    Без output_path возвращает JPEG-байты результата
     """
-    print(f"Начинаю загрузку файла {file_path} на Google Drive")
-    
-    if drive_service is None:
-        print("ОШИБКА: drive_service is None - сервис Google Drive не инициализирован")
+    image_bytes = fetch_image_bytes(base_image_url)
+    if image_bytes is None:
         return None
-        
-    if not os.path.exists(file_path):
-        print(f"ОШИБКА: Файл {file_path} не существует")
+    return render_overlay(image_bytes, overlay_path, output_path)
+
+def add_shop_image(base_image_url, shop_image_path, output_path=None):
+    """
+    Добавляет изображение магазина к первому изображению товара в виде коллажа.
+    Без output_path возвращает JPEG-байты результата
+    """
+    image_bytes = fetch_image_bytes(base_image_url)
+    if image_bytes is None:
         return None
-        
-    for attempt in range(1, max_retries + 1):
+    return render_shop_collage(image_bytes, shop_image_path, output_path)
+
+# Пулы параллельной обработки изображений (создаются при первом обращении)
+_io_pool = None
+_ad_pool = None
+_render_pool = None
+_pools_lock = threading.Lock()
+
+# Цикл событий асинхронного конвейера изображений (работает в отдельном потоке).
+# Сессия aiohttp и семафоры создаются и используются только внутри цикла
+_async_loop = None
+_async_thread = None
+_async_session = None
+_async_fetch_limit = None
+_async_drive_limit = None
+
+# Общий для процесса клиент Google Drive. httplib2 не потокобезопасен, поэтому
+# каждый поток выполняет запросы через собственное соединение (_thread_drive_http)
+_drive_credentials = None
+_drive_service = None
+_drive_client_lock = threading.Lock()
+_drive_local = threading.local()
+
+def get_drive_credentials():
+    """
+    Учетные данные сервисного аккаунта: файл читается один раз за процесс,
+    токен доступа обновляется заблаговременно, до истечения срока действия
+    """
+    global _drive_credentials
+    with _drive_client_lock:
+        if _drive_credentials is None:
+            _drive_credentials = service_account.Credentials.from_service_account_file(
+                GOOGLE_CRED_PATH,
+                scopes=DRIVE_SCOPES
+            )
+        credentials = _drive_credentials
+        expiry = credentials.expiry
+        if (not credentials.token or expiry is None
+                or expiry - datetime.utcnow() < timedelta(seconds=DRIVE_TOKEN_REFRESH_MARGIN)):
+            credentials.refresh(GoogleAuthRequest())
+        return credentials
+
+def _thread_drive_http():
+    """Авторизованное httplib2-соединение текущего потока (создается один раз на поток)"""
+    http = getattr(_drive_local, "http", None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(
+            get_drive_credentials(),
+            http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT)
+        )
+        _drive_local.http = http
+    return http
+
+def _build_drive_request(http, *args, **kwargs):
+    """Создает запрос Drive API на соединении того потока, который его выполняет"""
+    get_drive_credentials()
+    return HttpRequest(_thread_drive_http(), *args, **kwargs)
+
+def get_drive_service():
+    """
+    Возвращает общий для процесса клиент Google Drive API. Учетные данные и
+    описание API загружаются один раз; клиент можно использовать из любых потоков
+    """
+    global _drive_service
+    if _drive_service is None:
+        credentials = get_drive_credentials()
+        with _drive_client_lock:
+            if _drive_service is None:
+                _drive_service = build(
+                    'drive', 'v3',
+                    credentials=credentials,
+                    requestBuilder=_build_drive_request,
+                    static_discovery=True
+                )
+    return _drive_service
+
+def _get_io_pool():
+    """Пул потоков для сетевых операций: скачивание и загрузка изображений"""
+    global _io_pool
+    with _pools_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="avito-io")
+        return _io_pool
+
+def _get_ad_pool():
+    """Пул потоков для одновременной обработки нескольких объявлений"""
+    global _ad_pool
+    with _pools_lock:
+        if _ad_pool is None:
+            _ad_pool = ThreadPoolExecutor(max_workers=AD_WORKERS, thread_name_prefix="avito-ad")
+        return _ad_pool
+
+def _get_render_pool():
+    """
+    Пул процессов для наложения изображений (PIL).
+    Возвращает None, если пул не запущен через start_pools - тогда рендеринг
+    выполняется в текущем процессе.
+    """
+    with _pools_lock:
+        return _render_pool
+
+def start_pools():
+    """
+    Запускает пул процессов рендеринга. Должна вызываться из основного потока
+    до начала сетевых операций: процессы создаются через fork, пока в процессе
+    еще нет рабочих потоков, удерживающих блокировки.
+    """
+    global _render_pool
+    if RENDER_WORKERS <= 1:
+        return
+    with _pools_lock:
+        if _render_pool is not None:
+            return
         try:
-            file_name = os.path.basename(file_path)
-            
-            # Проверим, существует ли папка для изображений
-            folder_id = None
-            try:
-                print(f"Поиск папки {IMAGES_FOLDER_NAME} на Google Drive")
-                response = drive_service.files().list(
-                    q=f"name='{IMAGES_FOLDER_NAME}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
-                    spaces='drive',
-                    fields='files(id, name)'
-                ).execute()
-                
-                if not response.get('files'):
-                    # Создаем папку для изображений
-                    print(f"Папка {IMAGES_FOLDER_NAME} не найдена, создаю новую")
-                    folder_metadata = {
-                        'name': IMAGES_FOLDER_NAME,
-                        'mimeType': 'application/vnd.google-apps.folder'
-                    }
-                    folder = drive_service.files().create(
-                        body=folder_metadata,
-                        fields='id'
-                    ).execute()
-                    folder_id = folder.get('id')
-                    print(f"Создана папка с ID: {folder_id}")
-                    
-                    # Устанавливаем доступ на редактирование для папки
-                    drive_service.permissions().create(
-                        fileId=folder_id,
-                        body={
-                            'type': 'anyone',
-                            'role': 'writer',  # изменено с 'reader' на 'writer'
-                        }
-                    ).execute()
-                    print("Права доступа к папке установлены")
-                else:
-                    folder_id = response.get('files')[0].get('id')
-                    print(f"Найдена существующая папка с ID: {folder_id}")
-            except Exception as e:
-                print(f"Ошибка при работе с папкой на Google Drive: {e}")
-                # Если не удалось получить/создать папку, загружаем файл в корень
-                folder_id = None
-            
-            # Загружаем файл в папку или корень
-            file_metadata = {
-                'name': file_name
-            }
-            
-            # Добавляем папку, если она создана/получена
-            if folder_id:
-                file_metadata['parents'] = [folder_id]
-                print(f"Файл будет загружен в папку {folder_id}")
+            # fork позволяет дочерним процессам работать с модулем, загруженным через SourceFileLoader
+            if "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
             else:
-                print("Файл будет загружен в корневую папку")
-            
-            # Используем меньший таймаут для предотвращения зависаний
-            print(f"Подготовка файла {file_path} для загрузки")
-            media = MediaFileUpload(file_path, resumable=True, chunksize=1024*1024)
-            print("Начало загрузки файла")
-            file = drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
-            
-            file_id = file.get('id')
-            print(f"Файл загружен с ID: {file_id}")
-            
-            # Устанавливаем доступ на редактирование для файла
-            print("Установка прав доступа для файла")
-            drive_service.permissions().create(
-                fileId=file_id,
-                body={
-                    'type': 'anyone',
-                    'role': 'writer',  # изменено с 'reader' на 'writer'
-                }
-            ).execute()
-            print("Права доступа установлены")
-            
-            # Получаем прямую ссылку для просмотра - это прямая ссылка на содержимое
-            # Формат прямой ссылки для файлов на Google Drive
-            direct_url = f"https://drive.google.com/uc?export=view&id={file_id}"
-            print(f"Сгенерирована ссылка на файл: {direct_url}")
-            
-            # Если успешно - возвращаем ссылку и завершаем функцию
-            return direct_url
-            
+                context = multiprocessing.get_context()
+            render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=context,
+                initializer=warm_overlay_cache
+            )
+            # Первая задача сразу создает все процессы пула
+            render_pool.submit(warm_overlay_cache).result()
+            _render_pool = render_pool
         except Exception as e:
-            print(f"Ошибка при загрузке изображения на Google Drive (попытка {attempt} из {max_retries}): {e}")
-            import traceback
-            traceback.print_exc()
-            if attempt < max_retries:
-                print(f"Повторная попытка через {retry_delay} секунд...")
-                time.sleep(retry_delay)
-    
-    # Если все попытки неудачны, возвращаем None
-    print(f"Не удалось загрузить изображение {file_path} на Google Drive после {max_retries} попыток.")
-    return None
+            print(f"Не удалось запустить пул процессов, рендеринг будет выполняться в текущем процессе: {e}")
 
-def process_images(ad_element, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
-    """Обработка изображений для объявления"""
-    print(f"Запуск process_images для {ad_id}, gdrive_service: {'Инициализирован' if gdrive_service else 'None'}")
-    
-    # Попробуем получить изображения различными способами
-    images = ad_element.findall(".//Image")
+def async_pipeline_enabled():
+    """Включен ли асинхронный конвейер изображений (и доступен ли aiohttp)"""
+    return IMAGE_PIPELINE == "async" and aiohttp is not None
+
+def _get_async_loop():
+    """Цикл событий асинхронного конвейера; поток с ним запускается при первом обращении"""
+    global _async_loop, _async_thread
+    with _pools_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="avito-async", daemon=True)
+            thread.start()
+            _async_loop, _async_thread = loop, thread
+        return _async_loop
+
+async def _get_async_session():
+    """
+    Общая сессия aiohttp: соединения переиспользуются, их количество ограничено
+    ASYNC_FETCH_CONCURRENCY (и ASYNC_CONNECTIONS_PER_HOST для одного хоста)
+    """
+    global _async_session, _async_fetch_limit, _async_drive_limit
+    if _async_session is None:
+        connector = aiohttp.TCPConnector(
+            limit=ASYNC_FETCH_CONCURRENCY,
+            limit_per_host=ASYNC_CONNECTIONS_PER_HOST
+        )
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_TIMEOUT[0], sock_read=HTTP_TIMEOUT[1])
+        _async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _async_fetch_limit = asyncio.Semaphore(ASYNC_FETCH_CONCURRENCY)
+        _async_drive_limit = asyncio.Semaphore(ASYNC_DRIVE_CONCURRENCY)
+    return _async_session
+
+async def _close_async_session():
+    global _async_session
+    if _async_session is not None:
+        await _async_session.close()
+        _async_session = None
+
+def _stop_async_loop():
+    """Закрывает сессию aiohttp и останавливает цикл событий (вызывается под _pools_lock)"""
+    global _async_loop, _async_thread
+    if _async_loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_close_async_session(), _async_loop).result(timeout=30)
+    except Exception as e:
+        print(f"Ошибка при закрытии сессии aiohttp: {e}")
+    _async_loop.call_soon_threadsafe(_async_loop.stop)
+    _async_thread.join()
+    _async_loop.close()
+    _async_loop = _async_thread = None
+
+def shutdown_pools():
+    """Останавливает все пулы параллельной обработки и цикл событий асинхронного конвейера"""
+    global _io_pool, _ad_pool, _render_pool
+    with _pools_lock:
+        _stop_async_loop()
+        for pool in (_ad_pool, _io_pool, _render_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        _io_pool = _ad_pool = _render_pool = None
+
+def run_render(render_func, *args):
+    """
+    Выполняет функцию рендеринга в пуле процессов и ждет результат.
+    Вызывается из потоков IO_WORKERS, поэтому одновременно в пуле не больше
+    IO_WORKERS задач. При недоступности пула выполняет её в текущем процессе.
+    """
+    global _render_pool
+    render_pool = _get_render_pool()
+    if render_pool is None:
+        return render_func(*args)
+    try:
+        return render_pool.submit(render_func, *args).result()
+    except BrokenProcessPool as e:
+        # Процесс пула аварийно завершился - пул больше не принимает задачи.
+        # Отключаем его; новый пул создаст start_pools в начале следующего цикла
+        print(f"Пул процессов рендеринга неработоспособен, до следующего цикла выполняем локально: {e}")
+        with _pools_lock:
+            if _render_pool is render_pool:
+                _render_pool = None
+        render_pool.shutdown(wait=False)
+        return render_func(*args)
+    except Exception as e:
+        print(f"Ошибка в пуле процессов рендеринга, выполняем локально: {e}")
+        return render_func(*args)
+
+# Состояние Google Drive (ID папок и файлов), сохраняемое между запусками
+_drive_state = None
+_drive_state_lock = threading.Lock()
+
+def _load_drive_state():
+    """Загружает состояние Google Drive из DRIVE_STATE_PATH (вызывается под блокировкой)"""
+    global _drive_state
+    if _drive_state is None:
+        _drive_state = {}
+        if os.path.exists(DRIVE_STATE_PATH):
+            try:
+                with open(DRIVE_STATE_PATH, 'r', encoding='utf-8') as f:
+                    _drive_state = json.load(f)
+            except Exception as e:
+                print(f"Не удалось прочитать {DRIVE_STATE_PATH}: {e}")
+    return _drive_state
+
+def _save_drive_state():
+    """Атомарно сохраняет состояние Google Drive на диск (вызывается под блокировкой)"""
+    tmp_path = f"{DRIVE_STATE_PATH}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(_drive_state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, DRIVE_STATE_PATH)
+    except Exception as e:
+        print(f"Не удалось сохранить {DRIVE_STATE_PATH}: {e}")
+
+def get_drive_state(section, key, default=None):
+    """Возвращает сохраненное значение из раздела состояния Google Drive"""
+    with _drive_state_lock:
+        return _load_drive_state().get(section, {}).get(key, default)
+
+def set_drive_state(section, key, value):
+    """Сохраняет значение в разделе состояния Google Drive (None удаляет ключ)"""
+    with _drive_state_lock:
+        state = _load_drive_state()
+        if value is None:
+            state.get(section, {}).pop(key, None)
+        else:
+            state.setdefault(section, {})[key] = value
+        _save_drive_state()
+
+# Права доступа "все, у кого есть ссылка, могут редактировать"
+PUBLIC_PERMISSION = {
+    'type': 'anyone',
+    'role': 'writer',  # изменено с 'reader' на 'writer'
+}
+
+# Файлы, загруженные вне общей папки, которым еще нужно выдать права доступа
+_pending_public_grants = []
+_pending_public_grants_lock = threading.Lock()
+
+def execute_drive_batch(drive_service, requests_list):
+    """
+    Выполняет вызовы Google Drive API пакетными запросами по DRIVE_BATCH_SIZE.
+    
+    Возвращает список кортежей (ответ, исключение) в порядке вызовов.
+    """
+    results = [(None, None)] * len(requests_list)
+    
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+    
+    for start in range(0, len(requests_list), DRIVE_BATCH_SIZE):
+        batch = drive_service.new_batch_http_request(callback=callback)
+        for index in range(start, min(start + DRIVE_BATCH_SIZE, len(requests_list))):
+            batch.add(requests_list[index], request_id=str(index))
+        batch.execute()
+    return results
+
+def queue_public_access(file_id):
+    """Откладывает выдачу прав доступа к файлу до flush_public_access"""
+    with _pending_public_grants_lock:
+        _pending_public_grants.append(file_id)
+
+def flush_public_access(drive_service):
+    """Выдает отложенные права доступа пакетными запросами"""
+    with _pending_public_grants_lock:
+        file_ids = list(_pending_public_grants)
+        _pending_public_grants.clear()
+    if not file_ids or drive_service is None:
+        return
+    
+    print(f"Установка прав доступа для {len(file_ids)} файлов пакетными запросами")
+    requests_list = [
+        drive_service.permissions().create(fileId=file_id, body=PUBLIC_PERMISSION)
+        for file_id in file_ids
+    ]
+    try:
+        results = execute_drive_batch(drive_service, requests_list)
+    except Exception as e:
+        print(f"Ошибка при пакетной установке прав доступа: {e}")
+        return
+    failed = [file_id for file_id, (_, exception) in zip(file_ids, results) if exception is not None]
+    if failed:
+        print(f"Не удалось установить права доступа для {len(failed)} файлов: {failed}")
+
+def resolve_drive_folder(drive_service, folder_name=IMAGES_FOLDER_NAME):
+    """
+    Возвращает ID папки на Google Drive, создавая её при необходимости.
+    ID запоминается на время работы процесса и между запусками; сбрасывается
+    только через invalidate_drive_folder (при ответе 404).
+    """
+    folder_id = get_drive_state("folders", folder_name)
+    if folder_id:
+        return folder_id
+    
+    with _drive_state_lock:
+        # Повторная проверка: папку мог найти другой поток, пока мы ждали блокировку
+        folder_id = _load_drive_state().get("folders", {}).get(folder_name)
+        if folder_id:
+            return folder_id
+        
+        print(f"Поиск папки {folder_name} на Google Drive")
+        response = drive_service.files().list(
+            q=f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
+            spaces='drive',
+            fields='files(id, name)'
+        ).execute()
+        
+        if not response.get('files'):
+            # Создаем папку для изображений
+            print(f"Папка {folder_name} не найдена, создаю новую")
+            folder_metadata = {
+                'name': folder_name,
+                'mimeType': 'application/vnd.google-apps.folder'
+            }
+            folder = drive_service.files().create(
+                body=folder_metadata,
+                fields='id'
+            ).execute()
+            folder_id = folder.get('id')
+            print(f"Создана папка с ID: {folder_id}")
+        else:
+            folder_id = response.get('files')[0].get('id')
+            print(f"Найдена существующая папка с ID: {folder_id}")
+        
+        # Устанавливаем доступ на редактирование для папки: файлы внутри наследуют
+        # его, поэтому отдельные права на каждый загруженный файл не нужны
+        drive_service.permissions().create(
+            fileId=folder_id,
+            body=PUBLIC_PERMISSION
+        ).execute()
+        print("Права доступа к папке установлены")
+        
+        _load_drive_state().setdefault("folders", {})[folder_name] = folder_id
+        _save_drive_state()
+        return folder_id
+
+def invalidate_drive_folder(folder_name=IMAGES_FOLDER_NAME):
+    """Сбрасывает сохраненный ID папки (папка удалена или недоступна)"""
+    print(f"Сброс сохраненного ID папки {folder_name}")
+    set_drive_state("folders", folder_name, None)
+
+def is_drive_not_found(error):
+    """Проверяет, что ошибка Google Drive API - это 404 (файл или папка не найдены)"""
+    return isinstance(error, HttpError) and getattr(error.resp, 'status', None) == 404
+
+def find_drive_file(drive_service, file_name):
+    """
+    Возвращает ID файла на Google Drive по имени или None. ID запоминается
+    между запусками, поэтому поиск по имени выполняется только один раз
+    """
+    file_id = get_drive_state("files", file_name)
+    if file_id:
+        return file_id
+    
+    response = drive_service.files().list(
+        q=f"name='{file_name}' and trashed=false",
+        spaces='drive',
+        fields='files(id, name)'
+    ).execute()
+    if not response.get('files'):
+        return None
+    file_id = response.get('files')[0].get('id')
+    set_drive_state("files", file_name, file_id)
+    return file_id
+
+def invalidate_drive_file(file_name):
+    """Сбрасывает сохраненные ID и версию файла (файл удален или недоступен)"""
+    print(f"Сброс сохраненного ID файла {file_name}")
+    set_drive_state("files", file_name, None)
+    set_drive_state("file_versions", file_name, None)
+
+def get_drive_file_version(drive_service, file_name):
+    """
+    Метаданные версии файла на Google Drive (md5Checksum, modifiedTime, version)
+    или None, если файла нет. При ответе 404 сохраненный ID сбрасывается и файл ищется заново
+    """
+    for attempt in range(2):
+        file_id = find_drive_file(drive_service, file_name)
+        if not file_id:
+            return None
+        try:
+            return drive_service.files().get(
+                fileId=file_id,
+                fields=f"id, {', '.join(DRIVE_FILE_VERSION_FIELDS)}"
+            ).execute()
+        except HttpError as e:
+            if not is_drive_not_found(e) or attempt:
+                raise
+            invalidate_drive_file(file_name)
+    return None
+
+def remember_drive_file_version(file_name, metadata):
+    """Запоминает версию файла на Google Drive, совпадающую с локальной копией"""
+    set_drive_state("file_versions", file_name, {field: metadata.get(field) for field in DRIVE_FILE_VERSION_FIELDS})
+
+def make_drive_media(source, mimetype=None):
+    """
+    Создает тело загрузки для Google Drive из пути к файлу или из байтов в памяти.
+    Небольшие файлы (до DRIVE_MULTIPART_THRESHOLD) загружаются одним multipart-запросом,
+    крупные - возобновляемой загрузкой частями по DRIVE_UPLOAD_CHUNK_SIZE
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        size = len(source)
+        resumable = size > DRIVE_MULTIPART_THRESHOLD
+        return MediaIoBaseUpload(BytesIO(source), mimetype=mimetype or 'application/octet-stream',
+                                 chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=resumable)
+    resumable = os.path.getsize(source) > DRIVE_MULTIPART_THRESHOLD
+    return MediaFileUpload(source, mimetype=mimetype, chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=resumable)
+
+def _drive_media_digest(media):
+    """Хеш содержимого загружаемого файла (для привязки сессии загрузки к содержимому)"""
+    digest = hashlib.sha256()
+    for begin in range(0, media.size(), DRIVE_UPLOAD_CHUNK_SIZE):
+        digest.update(media.getbytes(begin, DRIVE_UPLOAD_CHUNK_SIZE))
+    return digest.hexdigest()
+
+def execute_drive_upload(request, session_name):
+    """
+    Выполняет запрос загрузки на Google Drive и возвращает ответ API.
+    
+    Multipart-загрузка выполняется одним запросом. Для возобновляемой загрузки URI сессии
+    сохраняется в состоянии Google Drive (ключ - session_name и хеш содержимого), поэтому
+    после сбоя или перезапуска загрузка того же файла продолжается с места остановки
+    """
+    if request.resumable is None:
+        return request.execute()
+    
+    session_key = f"{session_name}:{_drive_media_digest(request.resumable)}"
+    session = get_drive_state("upload_sessions", session_key)
+    if session and time.time() - session["created"] >= DRIVE_UPLOAD_SESSION_TTL:
+        set_drive_state("upload_sessions", session_key, None)
+        session = None
+    if session:
+        # Запрос состояния сессии (PUT с Content-Range: bytes */размер) сообщает,
+        # сколько байт сервер уже принял; загрузка продолжается с этого места
+        print(f"Продолжаем прерванную загрузку {session_name}")
+        resp, content = request.http.request(
+            session["uri"], "PUT",
+            headers={"Content-Length": "0", "Content-Range": f"bytes */{request.resumable.size()}"}
+        )
+        if resp.status in (200, 201):
+            # Файл был загружен полностью до сбоя
+            set_drive_state("upload_sessions", session_key, None)
+            return request.postproc(resp, content)
+        if resp.status == 308:
+            request.resumable_uri = session["uri"]
+            request.resumable_progress = int(resp["range"].split("-")[1]) + 1 if "range" in resp else 0
+        else:
+            # Сессия истекла или недоступна - начинаем загрузку заново
+            set_drive_state("upload_sessions", session_key, None)
+            session = None
+    
+    response = None
+    try:
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+            finally:
+                # URI новой сессии сохраняем сразу, даже если первая же часть не загрузилась
+                if request.resumable_uri and (not session or session["uri"] != request.resumable_uri):
+                    session = {"uri": request.resumable_uri, "created": time.time()}
+                    set_drive_state("upload_sessions", session_key, session)
+            if status:
+                print(f"Загружено {int(status.progress() * 100)}% файла {session_name}")
+    except HttpError as e:
+        if e.resp.status in (404, 410):
+            # Сессия истекла - следующая попытка начнет загрузку заново
+            set_drive_state("upload_sessions", session_key, None)
+        raise
+    set_drive_state("upload_sessions", session_key, None)
+    return response
+
+def upload_image_to_gdrive(drive_service, file_path, max_retries=3, retry_delay=5, image_bytes=None):
+    """
+    Загружает изображение на Google Drive и возвращает публичную ссылку
+    
+    drive_service: Инициализированный сервис Google Drive API
+    file_path: Путь к локальному файлу (при загрузке из памяти - только имя файла)
+    max_retries: Максимальное количество попыток загрузки
+    retry_delay: Задержка между попытками в секундах
+    image_bytes: Содержимое изображения в памяти (тогда файл на диске не нужен)
+    
+    Возвращает: публичную ссылку на изображение
+    """
+    print(f"Начинаю загрузку файла {file_path} на Google Drive")
+    
+    if drive_service is None:
+        print("ОШИБКА: drive_service is None - сервис Google Drive не инициализирован")
+        return None
+        
+    if image_bytes is None and not os.path.exists(file_path):
+        print(f"ОШИБКА: Файл {file_path} не существует")
+        return None
+        
+    folder_id = None
+    for attempt in range(1, max_retries + 1):
+        try:
+            file_name = os.path.basename(file_path)
+            
+            # ID папки для изображений (запоминается на время работы и между запусками)
+            folder_id = None
+            try:
+                folder_id = resolve_drive_folder(drive_service, IMAGES_FOLDER_NAME)
+            except Exception as e:
+                print(f"Ошибка при работе с папкой на Google Drive: {e}")
+                # Если не удалось получить/создать папку, загружаем файл в корень
+                folder_id = None
+            
+            # Загружаем файл в папку или корень
+            file_metadata = {
+                'name': file_name
+            }
+            
+            # Добавляем папку, если она создана/получена
+            if folder_id:
+                file_metadata['parents'] = [folder_id]
+                print(f"Файл будет загружен в папку {folder_id}")
+            else:
+                print("Файл будет загружен в корневую папку")
+            
+            print(f"Подготовка файла {file_path} для загрузки")
+            media = make_drive_media(image_bytes if image_bytes is not None else file_path, 'image/jpeg')
+            print("Начало загрузки файла")
+            file = execute_drive_upload(drive_service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id'
+            ), f"create:{file_name}")
+            
+            file_id = file.get('id')
+            print(f"Файл загружен с ID: {file_id}")
+            
+            # Файл в общей папке наследует её права доступа; файлу в корне
+            # права выдаются позже, пакетным запросом (flush_public_access)
+            if not folder_id:
+                queue_public_access(file_id)
+            
+            # Получаем прямую ссылку для просмотра - это прямая ссылка на содержимое
+            # Формат прямой ссылки для файлов на Google Drive
+            direct_url = f"https://drive.google.com/uc?export=view&id={file_id}"
+            print(f"Сгенерирована ссылка на файл: {direct_url}")
+            
+            # Если успешно - возвращаем ссылку и завершаем функцию
+            return direct_url
+            
+        except Exception as e:
+            print(f"Ошибка при загрузке изображения на Google Drive (попытка {attempt} из {max_retries}): {e}")
+            if folder_id and is_drive_not_found(e):
+                # Сохраненная папка больше не существует - найдем или создадим её заново
+                invalidate_drive_folder(IMAGES_FOLDER_NAME)
+            import traceback
+            traceback.print_exc()
+            if attempt < max_retries:
+                print(f"Повторная попытка через {retry_delay} секунд...")
+                time.sleep(retry_delay)
+    
+    # Если все попытки неудачны, возвращаем None
+    print(f"Не удалось загрузить изображение {file_path} на Google Drive после {max_retries} попыток.")
+    return None
+
+def process_images(ad_element, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
+    """Обработка изображений для объявления"""
+    print(f"Запуск process_images для {ad_id}, gdrive_service: {'Инициализирован' if gdrive_service else 'None'}")
+    
+    # Попробуем получить изображения различными способами
+    images = ad_element.findall(".//Image")
     
     if not images:
         # Попробуем другой способ поиска изображений
@@ -398,6 +1561,281 @@ def process_images(ad_element, output_dir, ad_id, gdrive_service=None, shop_imag
     
     return process_image_urls(original_urls, output_dir, ad_id, gdrive_service, shop_image_path)
 
+def _upload_slot_image(gdrive_service, result_path, output_filename, cache_key=None, image_data=None):
+    """
+    Загружает обработанное изображение на Google Drive (из файла или из памяти,
+    если передан image_data) и запоминает ссылку в кэше
+    """
+    try:
+        print(f"Начинаем загрузку изображения {output_filename} на Google Drive")
+        file_url = upload_image_to_gdrive(gdrive_service, result_path, image_bytes=image_data)
+        if file_url:
+            print(f"Изображение {output_filename} загружено в Google Drive: {file_url}")
+            if cache_key:
+                image_cache_set_drive_url(cache_key, file_url)
+            return file_url
+        print(f"Ошибка: не удалось получить URL для изображения {output_filename}")
+    except Exception as e:
+        print(f"Исключение при загрузке в Google Drive: {e}")
+        import traceback
+        traceback.print_exc()
+    return None
+
+def _prepare_image_slot(i, img_url, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
+    """
+    Первый этап обработки изображения: путь сохранения, способ обработки,
+    ключ и запись кэша. Возвращает словарь с описанием слота для следующих этапов
+    """
+    # Определение пути сохранения
+    output_filename = f"{ad_id}_{i+1}.jpg"
+    output_path = os.path.join(output_dir, output_filename)
+    
+    # Определяем способ обработки и ресурс (оверлей/фото магазина), от которого зависит результат
+    if i == 0 and shop_image_path and os.path.exists(shop_image_path):
+        render_func, render_asset = render_shop_collage, shop_image_path
+    elif i < 4:  # Накладываем водяной знак только на первые 4 изображения
+        # Выбираем подходящий оверлей в зависимости от порядкового номера изображения
+        # Используем остаток от деления на длину списка, чтобы не выйти за границы
+        overlay_index = i % len(OVERLAY_IMAGES)
+        render_func, render_asset = render_overlay, OVERLAY_IMAGES[overlay_index]
+    else:
+        render_func, render_asset = None, None
+    
+    asset_digest = asset_hash(render_asset)
+    cache_key = image_cache_key(img_url, i, asset_digest)
+    cached = image_cache_get(cache_key)
+    if cached and not cached["blob"] and not gdrive_service:
+        # Без Google Drive нужен файл, а изображение было загружено только из памяти
+        cached = None
+    
+    return {
+        "index": i,
+        "url": img_url,
+        "ad_id": ad_id,
+        "output_path": output_path,
+        "output_filename": output_filename,
+        "render_func": render_func,
+        "render_asset": render_asset,
+        "asset_digest": asset_digest,
+        "cache_key": cache_key,
+        "cached": cached,
+        # Заголовки условного запроса, если изображение уже есть в кэше
+        "etag": cached["etag"] if cached else None,
+        "last_modified": cached["last_modified"] if cached else None,
+    }
+
+def _fetch_image_slot(slot):
+    """
+    Второй этап: условное скачивание исходного изображения. Изображения без
+    обработки скачиваются потоком сразу в файл, не загружаясь в память.
+    Возвращает кортеж в формате fetch_image_async
+    """
+    if slot["render_func"] is None:
+        download_path, source_hash, etag, last_modified, not_modified = fetch_image_to_file(
+            slot["url"], slot["output_path"], slot["etag"], slot["last_modified"]
+        )
+        return None, download_path, source_hash, etag, last_modified, not_modified
+    image_bytes, etag, last_modified, not_modified = fetch_image_conditional(
+        slot["url"], slot["etag"], slot["last_modified"]
+    )
+    source_hash = hashlib.sha256(image_bytes).hexdigest() if image_bytes is not None else None
+    return image_bytes, None, source_hash, etag, last_modified, not_modified
+
+def _render_image_slot(slot, download, gdrive_service=None):
+    """
+    Третий этап: наложение (в пуле процессов) и сохранение результата в кэш.
+    
+    Возвращает кортеж (результат, загрузка): если загрузка равна None, результат -
+    итоговый URL или путь (None при ошибке); иначе загрузка - аргументы для
+    _upload_image_slot (путь к файлу, данные в памяти, ключ кэша).
+    """
+    i, img_url, ad_id = slot["index"], slot["url"], slot["ad_id"]
+    output_path = slot["output_path"]
+    render_func, render_asset = slot["render_func"], slot["render_asset"]
+    asset_digest, cache_key, cached = slot["asset_digest"], slot["cache_key"], slot["cached"]
+    image_bytes, download_path, source_hash, etag, last_modified, not_modified = download
+    
+    if source_hash is not None:
+        if cached and cached["source_hash"] == source_hash:
+            # Скачанная копия не нужна: результат уже есть в кэше
+            if download_path:
+                os.remove(download_path)
+            # Сервер не поддерживает условные запросы, но содержимое не изменилось
+            not_modified = True
+            image_cache_put(cache_key, img_url, i, asset_digest, etag, last_modified,
+                            source_hash, cached["blob"], cached["drive_url"])
+    elif not not_modified:
+        return None, None
+    
+    if not_modified and cached:
+        print(f"Изображение {i+1} объявления {ad_id} не изменилось, используем кэш")
+        if gdrive_service and cached["drive_url"]:
+            return cached["drive_url"], None
+        materialize_cached_image(cached["blob"], output_path)
+        if gdrive_service:
+            return None, (output_path, None, cache_key)
+        return output_path, None
+    
+    # При загрузке на Google Drive результат наложения кодируется в память
+    # и загружается оттуда же, без записи и повторного чтения файла
+    image_data = None
+    render_output = None if gdrive_service else output_path
+    if render_func is render_shop_collage:
+        print(f"Добавление изображения магазина к первому изображению для объявления {ad_id}")
+        result_path = run_render(render_func, image_bytes, render_asset, render_output)
+    elif render_func is render_overlay:
+        print(f"Используем overlay {render_asset} для изображения {i+1} объявления {ad_id}")
+        result_path = run_render(render_func, image_bytes, render_asset, render_output)
+    else:
+        # Для остальных изображений сохраняем скачанный файл без водяного знака как есть
+        try:
+            print(f"Сохраняем изображение {i+1} без водяного знака для объявления {ad_id}")
+            os.replace(download_path, output_path)
+            result_path = output_path
+        except Exception as e:
+            print(f"Ошибка при сохранении изображения без водяного знака: {e}")
+            result_path = None
+    
+    if render_func is not None and render_output is None:
+        image_data, result_path = result_path, None
+    
+    if not result_path and not image_data:
+        return None, None
+    
+    # Сохраняем результат в кэш (для файла без обработки хеш уже посчитан при скачивании)
+    try:
+        if result_path:
+            blob = image_cache_add_blob(result_path, source_hash if render_func is None else None)
+        elif IMAGE_WRITE_THROUGH:
+            # Копия на диске: файл в кэше и жесткая ссылка на него в processed_images
+            blob = image_cache_add_bytes(image_data)
+            result_path = materialize_cached_image(blob, output_path)
+        else:
+            blob = None
+        image_cache_put(cache_key, img_url, i, asset_digest, etag, last_modified, source_hash, blob)
+    except Exception as e:
+        print(f"Ошибка при сохранении изображения в кэш: {e}")
+        cache_key = None
+    
+    # Загрузка в Google Drive, если сервис предоставлен
+    if gdrive_service:
+        return None, (result_path, image_data, cache_key)
+    
+    # Если Google Drive не используется, сохраняем локальный путь
+    print(f"Google Drive не используется, сохранен локальный путь: {output_path}")
+    return output_path, None
+
+def _upload_image_slot(slot, gdrive_service, result_path, image_data, cache_key):
+    """
+    Последний этап: загрузка на Google Drive. В случае ошибки возвращает
+    локальный путь как запасной вариант (файл записывается, если его еще нет)
+    """
+    output_path, output_filename = slot["output_path"], slot["output_filename"]
+    file_url = _upload_slot_image(gdrive_service, output_path, output_filename, cache_key, image_data)
+    if file_url:
+        return file_url
+    if not result_path:
+        try:
+            write_file_atomic(output_path, image_data)
+        except Exception as e:
+            print(f"Ошибка при сохранении изображения {output_filename}: {e}")
+            return None
+    return output_path
+
+def _process_image_slot(i, img_url, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
+    """
+    Полный цикл обработки одного изображения объявления: скачивание,
+    наложение, сохранение и загрузка на Google Drive.
+    Возвращает URL (или локальный путь) обработанного изображения либо None.
+    
+    Результат кэшируется: при неизменном исходном изображении (ответ 304 или
+    тот же хеш содержимого) повторное наложение и загрузка не выполняются.
+    """
+    slot = _prepare_image_slot(i, img_url, output_dir, ad_id, gdrive_service, shop_image_path)
+    download = _fetch_image_slot(slot)
+    result, upload = _render_image_slot(slot, download, gdrive_service)
+    if upload is None:
+        return result
+    return _upload_image_slot(slot, gdrive_service, *upload)
+
+async def _process_image_slot_async(i, img_url, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
+    """
+    Асинхронный вариант _process_image_slot: скачивание выполняется в цикле событий
+    (не больше ASYNC_FETCH_CONCURRENCY одновременно), наложение - в пуле процессов
+    через пул потоков, загрузка на Google Drive - в пуле потоков, не больше
+    ASYNC_DRIVE_CONCURRENCY одновременно
+    """
+    loop = asyncio.get_running_loop()
+    session = await _get_async_session()
+    io_pool = _get_io_pool()
+    # Запрос к индексу кэша может ждать блокировку SQLite, поэтому выполняется вне цикла событий
+    slot = await loop.run_in_executor(
+        io_pool, _prepare_image_slot, i, img_url, output_dir, ad_id, gdrive_service, shop_image_path
+    )
+    output_path = slot["output_path"] if slot["render_func"] is None else None
+    async with _async_fetch_limit:
+        download = await fetch_image_async(session, img_url, output_path, slot["etag"], slot["last_modified"])
+    result, upload = await loop.run_in_executor(io_pool, _render_image_slot, slot, download, gdrive_service)
+    if upload is None:
+        return result
+    async with _async_drive_limit:
+        return await loop.run_in_executor(io_pool, _upload_image_slot, slot, gdrive_service, *upload)
+
+# Ссылки на фото магазина: (путь, хеш файла) -> URL
+_shop_image_urls = {}
+_shop_images_lock = threading.Lock()
+
+def get_shop_image_urls(output_dir, gdrive_service=None):
+    """
+    Возвращает ссылки на фото магазина из SHOP_IMAGES, общие для всех объявлений.
+    
+    Фото копируется в output_dir и загружается на Google Drive один раз;
+    повторная загрузка выполняется только при изменении хеша исходного файла.
+    Ссылки сохраняются между запусками в состоянии Google Drive.
+    """
+    shop_urls = []
+    with _shop_images_lock:
+        for i, shop_img_path in enumerate(SHOP_IMAGES):
+            try:
+                digest = asset_hash(shop_img_path)
+                mode = "gdrive" if gdrive_service else "local"
+                memo_key = (shop_img_path, digest, mode)
+                if memo_key in _shop_image_urls:
+                    shop_urls.append(_shop_image_urls[memo_key])
+                    continue
+                
+                shop_output_path = os.path.join(output_dir, f"shop_{i+1}.jpg")
+                
+                # Копируем фото магазина (жесткой ссылкой, если возможно), только если копии нет или она устарела
+                if not same_file(shop_img_path, shop_output_path) and (
+                        not os.path.exists(shop_output_path) or asset_hash(shop_output_path) != digest):
+                    link_or_copy(shop_img_path, shop_output_path)
+                    print(f"Скопировано изображение магазина {shop_img_path} -> {shop_output_path}")
+                
+                shop_url = shop_output_path
+                if gdrive_service:
+                    saved = get_drive_state("shop_images", shop_img_path)
+                    if saved and saved.get("hash") == digest:
+                        shop_url = saved["url"]
+                    else:
+                        print(f"Загрузка изображения магазина {shop_img_path} на Google Drive")
+                        uploaded_url = upload_image_to_gdrive(gdrive_service, shop_output_path)
+                        if uploaded_url:
+                            shop_url = uploaded_url
+                            set_drive_state("shop_images", shop_img_path, {"hash": digest, "url": uploaded_url})
+                            print(f"Изображение магазина загружено в Google Drive: {uploaded_url}")
+                        else:
+                            # Если не удалось загрузить, используем локальный путь (и повторим позже)
+                            print("Не удалось загрузить изображение магазина в Google Drive, используем локальный путь")
+                            shop_urls.append(shop_url)
+                            continue
+                
+                _shop_image_urls[memo_key] = shop_url
+                shop_urls.append(shop_url)
+            except Exception as e:
+                print(f"Ошибка при подготовке изображения магазина {shop_img_path}: {e}")
+    return shop_urls
+
 def process_image_urls(original_urls, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
     """Обработка URL изображений для объявления"""
     if not original_urls:
@@ -405,109 +1843,87 @@ def process_image_urls(original_urls, output_dir, ad_id, gdrive_service=None, sh
 
     processed_urls = []  # Список URL обработанных изображений
 
-    # Обработка изображений
-    for i, img_url in enumerate(original_urls):
-        if not img_url:
-            continue
-
-        # Определение пути сохранения
-        output_filename = f"{ad_id}_{i+1}.jpg"
-        output_path = os.path.join(output_dir, output_filename)
-
-        # Определяем, нужно ли использовать add_shop_image для первого изображения
-        if i == 0 and shop_image_path and os.path.exists(shop_image_path):
-            print(f"Добавление изображения магазина к первому изображению для объявления {ad_id}")
-            result_path = add_shop_image(img_url, shop_image_path, output_path)
-        elif i < 4:  # Накладываем водяной знак только на первые 4 изображения
-            # Выбираем подходящий оверлей в зависимости от порядкового номера изображения
-            # Используем остаток от деления на длину списка, чтобы не выйти за границы
-            overlay_index = i % len(OVERLAY_IMAGES)
-            overlay_path = OVERLAY_IMAGES[overlay_index]
-            print(f"Используем overlay {overlay_path} для изображения {i+1} объявления {ad_id}")
-            
-            result_path = overlay_image(img_url, overlay_path, output_path)
-        else:
-            # Для остальных изображений просто сохраняем без водяного знака
-            try:
-                print(f"Сохраняем изображение {i+1} без водяного знака для объявления {ad_id}")
-                response = requests.get(img_url)
-                if response.status_code == 200:
-                    with open(output_path, 'wb') as f:
-                        f.write(response.content)
-                    result_path = output_path
-                else:
-                    print(f"Ошибка загрузки изображения {img_url}, код: {response.status_code}")
-                    result_path = None
-            except Exception as e:
-                print(f"Ошибка при сохранении изображения без водяного знака: {e}")
-                result_path = None
-        
-        if result_path:
-            # Загрузка в Google Drive, если сервис предоставлен
-            if gdrive_service:
-                try:
-                    print(f"Начинаем загрузку изображения {output_filename} на Google Drive")
-                    file_url = upload_image_to_gdrive(gdrive_service, result_path)
-                    if file_url:
-                        processed_urls.append(file_url)
-                        print(f"Изображение {output_filename} загружено в Google Drive: {file_url}")
-                    else:
-                        print(f"Ошибка: не удалось получить URL для изображения {output_filename}")
-                        # В случае ошибки загружаем локальный путь как запасной вариант
-                        processed_urls.append(output_path)
-                except Exception as e:
-                    print(f"Исключение при загрузке в Google Drive: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    # В случае исключения загружаем локальный путь
-                    processed_urls.append(output_path)
-            else:
-                # Если Google Drive не используется, сохраняем локальный путь
-                processed_urls.append(output_path)
-                print(f"Google Drive не используется, сохранен локальный путь: {output_path}")
+    # Изображения обрабатываются параллельно, результаты собираются в исходном порядке
+    io_pool = _get_io_pool()
+    futures = [
+        io_pool.submit(_process_image_slot, i, img_url, output_dir, ad_id, gdrive_service, shop_image_path)
+        for i, img_url in enumerate(original_urls)
+        if img_url
+    ]
+    for future in futures:
+        try:
+            result_url = future.result()
+        except Exception as e:
+            print(f"Ошибка при обработке изображения для объявления {ad_id}: {e}")
+            result_url = None
+        if result_url:
+            processed_urls.append(result_url)
     
-    # Добавляем изображения магазина, если осталось место (максимум 10 изображений)
+    return add_shop_image_urls(processed_urls, output_dir, ad_id, gdrive_service)
+
+def add_shop_image_urls(processed_urls, output_dir, ad_id, gdrive_service=None):
+    """Добавляет изображения магазина, если осталось место (максимум 10 изображений)"""
     remaining_slots = 10 - len(processed_urls)
     if remaining_slots > 0 and SHOP_IMAGES:
         print(f"Осталось {remaining_slots} слотов для изображений магазина")
         
-        # Добавляем столько изображений магазина, сколько поместится
-        shop_images_to_add = min(remaining_slots, len(SHOP_IMAGES))
-        print(f"Добавляем {shop_images_to_add} изображений магазина")
-        
-        for i in range(shop_images_to_add):
-            shop_img_path = SHOP_IMAGES[i]
-            shop_output_path = os.path.join(output_dir, f"{ad_id}_shop_{i+1}.jpg")
-            
-            try:
-                # Копируем файлы магазина
-                with open(shop_img_path, 'rb') as src, open(shop_output_path, 'wb') as dst:
-                    dst.write(src.read())
-                print(f"Скопировано изображение магазина {shop_img_path} -> {shop_output_path}")
-                
-                # Загружаем изображение магазина в Google Drive, если доступно
-                if gdrive_service:
-                    try:
-                        shop_url = upload_image_to_gdrive(gdrive_service, shop_output_path)
-                        if shop_url:
-                            processed_urls.append(shop_url)
-                            print(f"Изображение магазина загружено в Google Drive: {shop_url}")
-                        else:
-                            # Если не удалось загрузить, используем локальный путь
-                            processed_urls.append(shop_output_path)
-                            print(f"Не удалось загрузить изображение магазина в Google Drive, используем локальный путь")
-                    except Exception as e:
-                        print(f"Ошибка при загрузке изображения магазина в Google Drive: {e}")
-                        processed_urls.append(shop_output_path)
-                else:
-                    processed_urls.append(shop_output_path)
-                    print(f"Google Drive не используется, сохранен локальный путь для изображения магазина: {shop_output_path}")
-            except Exception as e:
-                print(f"Ошибка при копировании изображения магазина {shop_img_path}: {e}")
+        # Фото магазина одинаковы для всех объявлений: используем общие ссылки
+        shop_urls = get_shop_image_urls(output_dir, gdrive_service)
+        print(f"Добавляем {min(remaining_slots, len(shop_urls))} изображений магазина")
+        processed_urls.extend(shop_urls[:remaining_slots])
     
     print(f"Обработка изображений для {ad_id} завершена, результат: {processed_urls}")
     return processed_urls
 
+def ad_image_urls(ad_element):
+    """URL изображений объявления: текст элементов Image или их атрибут url, иначе атрибуты url в секции Images"""
+    images = ad_element.findall(".//Image")
+    if images:
+        return [img.text or img.attrib.get('url') for img in images if img.text or img.attrib.get('url')]
+    images_section = ad_element.find("Images")
+    if images_section is None:
+        return []
+    return [child.attrib['url'] for child in images_section if 'url' in child.attrib]
+
+async def process_images_async(ad_element, output_dir, ad_id, gdrive_service=None, shop_image_path=None):
+    """Асинхронный вариант process_images: все изображения объявления обрабатываются одновременно"""
+    original_urls = ad_image_urls(ad_element)
+    if not original_urls:
+        print(f"Для {ad_id} не найдены изображения в XML")
+        return []
+    
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Найдено {len(original_urls)} изображений для {ad_id}: {original_urls}")
+    
+    results = await asyncio.gather(
+        *(_process_image_slot_async(i, img_url, output_dir, ad_id, gdrive_service, shop_image_path)
+          for i, img_url in enumerate(original_urls)),
+        return_exceptions=True
+    )
+    processed_urls = []
+    for result_url in results:
+        if isinstance(result_url, Exception):
+            print(f"Ошибка при обработке изображения для объявления {ad_id}: {result_url}")
+        elif result_url:
+            processed_urls.append(result_url)
+    
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_io_pool(), add_shop_image_urls, processed_urls, output_dir, ad_id, gdrive_service
+    )
+
+def submit_ad_images(ad_element, output_dir, ad_id, gdrive_service=None):
+    """
+    Ставит обработку изображений объявления в выбранный конвейер (IMAGE_PIPELINE)
+    и возвращает concurrent.futures.Future с результатом process_images
+    """
+    if async_pipeline_enabled():
+        return asyncio.run_coroutine_threadsafe(
+            process_images_async(ad_element, output_dir, ad_id, gdrive_service),
+            _get_async_loop()
+        )
+    return _get_ad_pool().submit(process_images, ad_element, output_dir, ad_id, gdrive_service)
+
 def resize_image(image_path, max_size=160):
     """
     Изменяет размер изображения, сохраняя соотношение сторон, чтобы наибольшая сторона была max_size пикселей.
@@ -518,50 +1934,14 @@ def resize_image(image_path, max_size=160):
         resized_img = img.resize(new_size, PILImage.LANCZOS)
         return resized_img
 
-def save_to_excel(df, output_path=OUTPUT_EXCEL_PATH):
-    """Сохранение DataFrame в Excel-файл"""
+def save_to_excel(df, output_path=OUTPUT_EXCEL_PATH, fingerprints=None):
+    """Добавление новых строк DataFrame в хранилище товаров и выгрузка Excel-файла"""
+    if not append_products(df, fingerprints) and os.path.exists(output_path):
+        return output_path, False  # Файл не был обновлен
     
-    # Проверяем, существует ли уже файл Excel
-    if os.path.exists(output_path):
-        # Загружаем существующие данные
-        existing_data = pd.read_excel(output_path)
-        
-        # Создаем копию существующих данных
-        merged_df = existing_data.copy()
-        
-        # Проверяем новые данные из df на отсутствие в существующей таблице по Id
-        if 'Id' in df.columns and 'Id' in existing_data.columns:
-            # Получаем список существующих Id
-            existing_ids = set(existing_data['Id'].astype(str).tolist())
-            
-            # Фильтруем новые данные, оставляя только отсутствующие
-            new_rows = df[~df['Id'].astype(str).isin(existing_ids)]
-            
-            # Если есть новые строки, добавляем их в конец существующей таблицы
-            if len(new_rows) > 0:
-                print(f"Добавление {len(new_rows)} новых строк к существующим {len(existing_data)}")
-                
-                # Добавляем новые строки в конец
-                merged_df = pd.concat([existing_data, new_rows], ignore_index=True)
-                
-                # Сохраняем обновленную таблицу
-                merged_df.to_excel(output_path, index=False)
-                
-                return output_path, True  # Файл был обновлен
-            else:
-                print("Нет новых строк для добавления")
-                return output_path, False  # Файл не был обновлен
-        else:
-            print("Отсутствует столбец 'Id' в исходных данных или в новых данных")
-            # Если нет Id в одном из DataFrame, просто добавляем новые строки в конец
-            merged_df = pd.concat([existing_data, df], ignore_index=True)
-            merged_df.to_excel(output_path, index=False)
-            return output_path, True  # Файл был обновлен
-    else:
-        # Если файл не существует, создаем новый
-        df.to_excel(output_path, index=False)
-        print(f"Создан новый Excel-файл: {output_path}")
-        return output_path, True  # Файл был создан
+    # Выгружаем обновленную таблицу
+    export_products_to_excel(output_path)
+    return output_path, True  # Файл был обновлен
 
 def upload_to_google_drive(file_path, force_update=True):
     """
@@ -572,66 +1952,64 @@ def upload_to_google_drive(file_path, force_update=True):
                   если False, то существующий файл не будет обновлен
     """
     try:
-        # Аутентификация с помощью сервисного аккаунта
-        credentials = service_account.Credentials.from_service_account_file(
-            GOOGLE_CRED_PATH, 
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        
-        # Создание сервиса Drive API
-        drive_service = build('drive', 'v3', credentials=credentials)
+        # Общий клиент Drive API (учетные данные и описание API уже загружены)
+        drive_service = get_drive_service()
         
         # Название файла в Google Drive
         file_name = os.path.basename(file_path)
         
-        # Проверка, существует ли файл с таким именем
-        response = drive_service.files().list(
-            q=f"name='{file_name}' and trashed=false",
-            spaces='drive',
-            fields='files(id, name)'
-        ).execute()
+        # Проверка, существует ли файл с таким именем (ID сохраняется между запусками)
+        file_id = find_drive_file(drive_service, file_name)
+        version_fields = f"id, {', '.join(DRIVE_FILE_VERSION_FIELDS)}"
         
-        file_id = None
+        if file_id:
+            if force_update:
+                # Обновляем существующий файл только если требуется обновление
+                try:
+                    media = make_drive_media(file_path)
+                    file = execute_drive_upload(drive_service.files().update(
+                        fileId=file_id,
+                        media_body=media,
+                        fields=version_fields
+                    ), f"update:{file_id}")
+                    # Запоминаем версию, чтобы не скачивать свою же загрузку обратно
+                    remember_drive_file_version(file_name, file)
+                    print(f'Файл обновлен на Google Drive, ID: {file_id}')
+                except HttpError as e:
+                    if not is_drive_not_found(e):
+                        raise
+                    # Файл удален на Google Drive - создаем новый
+                    invalidate_drive_file(file_name)
+                    file_id = None
+            else:
+                print(f'Используется существующий файл на Google Drive, ID: {file_id}')
         
-        if not response.get('files'):
+        if not file_id:
             # Создание нового файла
             file_metadata = {
                 'name': file_name,
                 'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
             }
-            media = MediaFileUpload(file_path, resumable=True)
-            file = drive_service.files().create(
+            media = make_drive_media(file_path)
+            file = execute_drive_upload(drive_service.files().create(
                 body=file_metadata,
                 media_body=media,
-                fields='id'
-            ).execute()
+                fields=version_fields
+            ), f"create:{file_name}")
             file_id = file.get("id")
+            set_drive_state("files", file_name, file_id)
+            remember_drive_file_version(file_name, file)
             print(f'Файл загружен на Google Drive, ID: {file_id}')
-        else:
-            # Файл уже существует
-            file_id = response.get('files')[0].get('id')
-            
-            if force_update:
-                # Обновляем существующий файл только если требуется обновление
-                media = MediaFileUpload(file_path, resumable=True)
-                file = drive_service.files().update(
-                    fileId=file_id,
-                    media_body=media,
-                    fields='id'
-                ).execute()
-                print(f'Файл обновлен на Google Drive, ID: {file_id}')
-            else:
-                print(f'Используется существующий файл на Google Drive, ID: {file_id}')
         
         # Установка доступа на редактирование для всех, у кого есть ссылка
-        drive_service.permissions().create(
-            fileId=file_id,
-            body={
-                'type': 'anyone',
-                'role': 'writer',  # изменено с 'reader' на 'writer'
-            }
-        ).execute()
-        print(f'Установлены права на редактирование для всех, у кого есть ссылка')
+        # (один раз для каждого файла, отметка сохраняется между запусками)
+        if not get_drive_state("shared", file_id):
+            drive_service.permissions().create(
+                fileId=file_id,
+                body=PUBLIC_PERMISSION
+            ).execute()
+            set_drive_state("shared", file_id, True)
+            print(f'Установлены права на редактирование для всех, у кого есть ссылка')
         
         # Формирование ссылки на документ
         file_url = f"https://docs.google.com/spreadsheets/d/{file_id}/edit?usp=sharing"
@@ -645,56 +2023,67 @@ def upload_to_google_drive(file_path, force_update=True):
         return None
 
 def sync_excel_from_gdrive():
-    """Скачивание актуальной версии Excel-файла с Google Drive перед обработкой"""
+    """
+    Скачивание актуальной версии Excel-файла с Google Drive перед обработкой.
+    Файл скачивается, только если он изменился на Google Drive (сравниваются
+    md5Checksum, modifiedTime и version с сохраненными при последней синхронизации)
+    
+    Returns:
+        bool: True, если скачана новая версия файла
+    """
     try:
         # Проверка наличия учетных данных
         if not os.path.exists(GOOGLE_CRED_PATH):
             print("Файл с учетными данными Google API не найден")
             return False
             
-        credentials = service_account.Credentials.from_service_account_file(
-            GOOGLE_CRED_PATH, 
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        
-        drive_service = build('drive', 'v3', credentials=credentials)
+        drive_service = get_drive_service()
         
         # Название файла в Google Drive
         file_name = os.path.basename(OUTPUT_EXCEL_PATH)
         
-        # Поиск файла на Google Drive
-        response = drive_service.files().list(
-            q=f"name='{file_name}' and trashed=false",
-            spaces='drive',
-            fields='files(id, name)'
-        ).execute()
-        
-        if not response.get('files'):
+        # Метаданные файла на Google Drive (по сохраненному ID, без поиска по имени)
+        metadata = get_drive_file_version(drive_service, file_name)
+        if metadata is None:
             print(f"Файл {file_name} не найден на Google Drive")
             return False
-            
-        file_id = response.get('files')[0].get('id')
+        file_id = metadata['id']
+        
+        remote_version = {field: metadata.get(field) for field in DRIVE_FILE_VERSION_FIELDS}
+        if os.path.exists(OUTPUT_EXCEL_PATH):
+            if get_drive_state("file_versions", file_name) == remote_version:
+                print(f"Файл {file_name} на Google Drive не изменился, скачивание пропущено")
+                return False
+            if metadata.get('md5Checksum') and file_digest(OUTPUT_EXCEL_PATH, "md5") == metadata['md5Checksum']:
+                remember_drive_file_version(file_name, metadata)
+                print(f"Локальный файл {file_name} совпадает с версией на Google Drive, скачивание пропущено")
+                return False
         
         # Скачивание файла
         request = drive_service.files().get_media(fileId=file_id)
         
+        # Скачиваем во временный файл, чтобы не повредить таблицу при обрыве
+        root_path, extension = os.path.splitext(OUTPUT_EXCEL_PATH)
+        tmp_path = f"{root_path}.download{extension}"
+        with open(tmp_path, 'wb') as f:
+            downloader = MediaIoBaseDownload(f, request)
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
+                print(f"Скачивание {int(status.progress() * 100)}%")
+        
         # Сохраняем текущий файл как резервную копию, если он существует
         if os.path.exists(OUTPUT_EXCEL_PATH):
             backup_path = f"{OUTPUT_EXCEL_PATH}.bak"
             try:
-                os.rename(OUTPUT_EXCEL_PATH, backup_path)
+                os.replace(OUTPUT_EXCEL_PATH, backup_path)
                 print(f"Создана резервная копия: {backup_path}")
             except Exception as e:
                 print(f"Не удалось создать резервную копию: {e}")
         
         # Сохраняем файл с Google Drive
-        with open(OUTPUT_EXCEL_PATH, 'wb') as f:
-            downloader = MediaIoBaseDownload(f, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-                print(f"Скачивание {int(status.progress() * 100)}%")
-                
+        os.replace(tmp_path, OUTPUT_EXCEL_PATH)
+        remember_drive_file_version(file_name, metadata)
         print(f"Файл {file_name} успешно скачан с Google Drive")
         return True
         
@@ -704,383 +2093,875 @@ def sync_excel_from_gdrive():
         traceback.print_exc()
         return False
 
+def replace_description(ad, ad_id):
+    """Вставляет новый текст описания (NEW_DESCRIPTION) в описание объявления"""
+    description = ad.find("Description")
+    if description is not None and description.text:
+        print(f"Обработка описания для {ad_id}")
+        # Проверяем, содержит ли текст CDATA
+        if "<![CDATA[" in description.text and "]]>" in description.text:
+            # Извлекаем содержимое CDATA
+            cdata_start = description.text.find("<![CDATA[") + 9
+            cdata_end = description.text.rfind("]]>")
+            cdata_content = description.text[cdata_start:cdata_end]
+
+            # Ищем маркер "Lada;"
+            lada_index = cdata_content.find("Lada;")
+            if lada_index != -1:
+                print(f"Найден маркер 'Lada;' в позиции {lada_index}")
+                # Всегда вставляем описание сразу после "Lada;"
+                new_cdata_content = cdata_content[:lada_index + 5] + NEW_DESCRIPTION + cdata_content[lada_index + 5:]
+                description.text = f"<![CDATA[{new_cdata_content}]]>"
+                print("Описание успешно вставлено после 'Lada;'")
+            else:
+                # Если нет "Lada;", ищем последний </p><p>
+                last_p_tag = cdata_content.rfind("</p><p>")
+                if last_p_tag != -1:
+                    print(f"Найден тег </p><p> в позиции {last_p_tag}")
+                    # Вставляем после последнего тега </p><p>
+                    tag_end = last_p_tag + len("</p><p>")
+                    new_cdata_content = cdata_content[:tag_end] + NEW_DESCRIPTION + cdata_content[tag_end:]
+                    description.text = f"<![CDATA[{new_cdata_content}]]>"
+                    print("Описание успешно вставлено после тега </p><p>")
+                else:
+                    print("Не найдены ни 'Lada;', ни </p><p>. Добавление в конец.")
+                    # Если нет тегов, вставляем в конец
+                    description.text = f"<![CDATA[{cdata_content}{NEW_DESCRIPTION}]]>"
+        else:
+            print("Текст не содержит CDATA")
+            # Если нет CDATA, просто добавляем описание в конец
+            lada_index = description.text.find("Lada;")
+            if lada_index != -1:
+                print(f"Найден маркер 'Lada;' в позиции {lada_index}")
+                # Вставляем описание сразу после "Lada;"
+                # Уже закодированное в исходном файле описание
+                description.text = description.text[:lada_index + 5] + NEW_DESCRIPTION + description.text[lada_index + 5:]
+                print("Описание успешно вставлено после 'Lada;'")
+            else:
+                print("Добавление описания в конец")
+                # Если нет "Lada;", добавляем в конец
+                description.text = description.text + NEW_DESCRIPTION
+
+def replace_xml_images(ad, processed_images):
+    """Заменяет изображения в секции Images объявления на обработанные"""
+    images_element = ad.find("Images")
+    if images_element is None:
+        return
+    
+    # Удаляем существующие изображения
+    for img in images_element.findall("Image"):
+        images_element.remove(img)
+        
+    # Добавляем новые изображения в XML
+    for i, img_path in enumerate(processed_images):
+        # Получаем соответствующий URL
+        img_url = img_path if isinstance(img_path, str) else img_path[0]
+        
+        # Создаём элемент для XML
+        img_elem = ET.SubElement(images_element, "Image")
+        img_elem.text = img_url
+        img_elem.set("url", img_url)
+
+def build_row_data(ad, all_parameters, image_urls_string):
+    """Собирает строку для Excel-таблицы из элемента объявления"""
+    # Собираем данные для Excel
+    row_data = {
+        # Указываем пустое значение для всех возможных параметров
+        param: "" for param in all_parameters
+    }
+
+    # Заполняем значения из объявления
+    for elem in ad:
+        if elem.tag in row_data and elem.text is not None:
+            # Очищаем CDATA если есть
+            if "<![CDATA[" in elem.text and "]]>" in elem.text:
+                cdata_start = elem.text.find("<![CDATA[") + 9
+                cdata_end = elem.text.rfind("]]>")
+                row_data[elem.tag] = elem.text[cdata_start:cdata_end]
+            else:
+                row_data[elem.tag] = elem.text
+
+    # Добавляем наши кастомные значения
+    row_data["InternetCalls"] = "Да"
+    row_data["CallsDevices"] = "3889715587"
+    row_data["ImageUrls"] = image_urls_string
+    
+    return row_data
+
+def ad_fingerprint(ad):
+    """
+    Отпечаток объявления: хеш нормализованного содержимого элемента <Ad>
+    (теги, атрибуты и текст без крайних пробелов) и списка URL изображений.
+    В отпечаток входит и новый текст описания, чтобы его изменение
+    приводило к повторной обработке всех объявлений.
+    """
+    digest = hashlib.sha256()
+    image_urls = []
+    for elem in ad.iter():
+        digest.update(elem.tag.encode('utf-8'))
+        for name, value in sorted(elem.attrib.items()):
+            digest.update(f"\x1f{name}={value}".encode('utf-8'))
+        digest.update(f"\x1e{(elem.text or '').strip()}\x1d".encode('utf-8'))
+        if elem.tag == "Image":
+            image_urls.append(elem.text or elem.attrib.get('url', ''))
+    digest.update("|".join(image_urls).encode('utf-8'))
+    digest.update(NEW_DESCRIPTION.encode('utf-8'))
+    return digest.hexdigest()
+
+# Подключение к хранилищу товаров (одно на процесс, под блокировкой)
+_products_conn = None
+_products_lock = threading.Lock()
+
+def _products_db():
+    """Открывает (и при необходимости создает) хранилище товаров"""
+    global _products_conn
+    if _products_conn is None:
+        conn = sqlite3.connect(PRODUCTS_DB, check_same_thread=False)
+        conn.executescript(
+            """CREATE TABLE IF NOT EXISTS products (
+                id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                image_urls TEXT NOT NULL DEFAULT '',
+                fingerprint TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_products_position ON products(position);
+            CREATE INDEX IF NOT EXISTS idx_products_missing_images ON products(id) WHERE image_urls = '';
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );"""
+        )
+        conn.commit()
+        _products_conn = conn
+    return _products_conn
+
+def _store_meta_get(conn, key, default=None):
+    """Читает служебное значение хранилища (JSON)"""
+    row = conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def _store_meta_set(conn, key, value):
+    """Записывает служебное значение хранилища (JSON)"""
+    conn.execute(
+        "INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)",
+        (key, json.dumps(value, ensure_ascii=False))
+    )
+
+def _normalize_image_urls(value):
+    """Приводит значение ImageUrls к строке; пустые значения и NaN - к пустой строке"""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ""
+    value = str(value).strip()
+    return "" if value == "nan" else value
+
+def _record_spreadsheet_change(conn, kind, count=1):
+    """
+    Отмечает изменение строк, которое еще не выгружено в Excel-таблицу.
+    Записывается в той же транзакции, что и само изменение, поэтому
+    не теряется при аварийном завершении до выгрузки
+    """
+    changes = _store_meta_get(conn, "pending_changes", {})
+    changes[kind] = changes.get(kind, 0) + count
+    _store_meta_set(conn, "pending_changes", changes)
+
+def _extend_store_columns(conn, rows):
+    """Добавляет в порядок столбцов таблицы новые столбцы из строк"""
+    columns = _store_meta_get(conn, "columns", [])
+    known = set(columns)
+    for row in rows:
+        for column in row:
+            if column not in known:
+                columns.append(column)
+                known.add(column)
+    _store_meta_set(conn, "columns", columns)
+
+def sync_products_from_excel(excel_path=OUTPUT_EXCEL_PATH):
+    """
+    Импортирует Excel-таблицу в хранилище товаров, если файл отличается от
+    последней выгрузки или импорта (например, таблицу изменили на Google Drive).
+    Отпечатки объявлений для сохранившихся товаров не теряются.
+    """
+    if not os.path.exists(excel_path):
+        return False
+    excel_hash = file_digest(excel_path)
+    with _products_lock:
+        if _store_meta_get(_products_db(), "excel_sha256") == excel_hash:
+            return False
+    
+    try:
+        existing_data = pd.read_excel(excel_path)
+    except Exception as e:
+        print(f"Ошибка при чтении существующего Excel-файла: {e}")
+        return False
+    if 'Id' not in existing_data.columns:
+        print(f"В файле {excel_path} отсутствует столбец 'Id', импорт в хранилище пропущен")
+        return False
+    
+    # Id и ImageUrls нормализуются операциями над столбцами, а не построчно
+    product_ids = existing_data['Id'].astype(str).tolist()
+    if 'ImageUrls' in existing_data.columns:
+        image_urls = existing_data['ImageUrls'].fillna("").astype(str).str.strip()
+        image_urls = image_urls.where(image_urls != "nan", "").tolist()
+    else:
+        image_urls = [""] * len(existing_data)
+    records = existing_data.astype(object).where(pd.notna(existing_data), None).to_dict('records')
+    now = time.time()
+    with _products_lock:
+        conn = _products_db()
+        fingerprints = dict(conn.execute("SELECT id, fingerprint FROM products"))
+        
+        # Перенос отпечатков из файла прежней версии
+        migrated_fingerprints = os.path.exists(FINGERPRINTS_PATH)
+        if migrated_fingerprints:
+            try:
+                with open(FINGERPRINTS_PATH, 'r', encoding='utf-8') as f:
+                    for product_id, fingerprint in json.load(f).items():
+                        if fingerprints.get(product_id) is None:
+                            fingerprints[product_id] = fingerprint
+            except Exception as e:
+                print(f"Не удалось прочитать {FINGERPRINTS_PATH}: {e}")
+        
+        conn.execute("DELETE FROM products")
+        conn.executemany(
+            """INSERT OR REPLACE INTO products (id, position, data, image_urls, fingerprint, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (
+                    product_id, position,
+                    json.dumps(record, ensure_ascii=False, default=str),
+                    record_image_urls, fingerprints.get(product_id), now, now
+                )
+                for position, (product_id, record, record_image_urls)
+                in enumerate(zip(product_ids, records, image_urls))
+            ]
+        )
+        _store_meta_set(conn, "columns", list(existing_data.columns))
+        _store_meta_set(conn, "excel_sha256", excel_hash)
+        _store_meta_set(conn, "pending_changes", {})
+        conn.commit()
+    if migrated_fingerprints:
+        os.remove(FINGERPRINTS_PATH)
+    print(f"Загружены данные из {excel_path} в хранилище товаров, строк: {len(records)}")
+    return True
+
+def product_store_ids():
+    """ID всех товаров в хранилище"""
+    with _products_lock:
+        return {row[0] for row in _products_db().execute("SELECT id FROM products")}
+
+def product_store_missing_images():
+    """ID товаров без изображений (по частичному индексу)"""
+    with _products_lock:
+        return {row[0] for row in _products_db().execute("SELECT id FROM products WHERE image_urls = ''")}
+
+def product_store_pending_changes():
+    """Изменения строк, еще не выгруженные в таблицу: {вид изменения: количество}"""
+    with _products_lock:
+        return _store_meta_get(_products_db(), "pending_changes", {})
+
+def product_store_image_retry_due():
+    """
+    Проверяет, есть ли товары без изображений, которые пора обработать снова: товар
+    еще не пытались обработать или наступило время повтора после неудачной попытки
+    """
+    now = time.time()
+    with _products_lock:
+        conn = _products_db()
+        retry_after = _store_meta_get(conn, "image_retry", {})
+        missing = [row[0] for row in conn.execute("SELECT id FROM products WHERE image_urls = ''")]
+    return any(retry_after.get(product_id, 0) <= now for product_id in missing)
+
+def product_store_schedule_image_retry(failed_ids, succeeded_ids):
+    """
+    Запоминает время следующей попытки для товаров, изображения которых не удалось
+    получить, и сбрасывает его для обработанных успешно
+    """
+    if not failed_ids and not succeeded_ids:
+        return
+    retry_time = time.time() + IMAGE_RETRY_INTERVAL_MINUTES * 60
+    with _products_lock:
+        conn = _products_db()
+        retry_after = _store_meta_get(conn, "image_retry", {})
+        for product_id in succeeded_ids:
+            retry_after.pop(product_id, None)
+        for product_id in failed_ids:
+            retry_after[product_id] = retry_time
+        # Записи удаленных товаров больше не нужны
+        existing = _store_existing_ids(conn, list(retry_after))
+        _store_meta_set(conn, "image_retry", {
+            product_id: value for product_id, value in retry_after.items() if product_id in existing
+        })
+        conn.commit()
+
+def product_store_fingerprints():
+    """Отпечатки объявлений, сохраненные для товаров при предыдущих запусках"""
+    with _products_lock:
+        return dict(_products_db().execute("SELECT id, fingerprint FROM products WHERE fingerprint IS NOT NULL"))
+
+def _store_existing_ids(conn, product_ids, chunk_size=500):
+    """Какие из указанных ID уже есть в хранилище (запросы по частям, без перебора строк)"""
+    product_ids = list(product_ids)
+    existing = set()
+    for start in range(0, len(product_ids), chunk_size):
+        chunk = product_ids[start:start + chunk_size]
+        placeholders = ", ".join("?" * len(chunk))
+        existing.update(
+            row[0] for row in conn.execute(f"SELECT id FROM products WHERE id IN ({placeholders})", chunk)
+        )
+    return existing
+
+def product_store_get_many(product_ids, chunk_size=500):
+    """Возвращает строки товаров (dict) по списку ID: {ID: строка}"""
+    product_ids = [str(product_id) for product_id in product_ids]
+    products = {}
+    with _products_lock:
+        conn = _products_db()
+        for start in range(0, len(product_ids), chunk_size):
+            chunk = product_ids[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            for product_id, data, image_urls in conn.execute(
+                f"SELECT id, data, image_urls FROM products WHERE id IN ({placeholders})", chunk
+            ):
+                products[product_id] = json.loads(data)
+                products[product_id]['ImageUrls'] = image_urls
+    return products
+
+def product_store_get(product_id):
+    """Возвращает строку товара (dict) или None"""
+    return product_store_get_many([product_id]).get(str(product_id))
+
+def product_store_upsert(rows, fingerprints=None):
+    """
+    Добавляет новые товары в конец таблицы или обновляет существующие (по Id),
+    сохраняя их позицию. fingerprints - отпечатки объявлений по ID товара.
+    Все строки записываются одной транзакцией
+    """
+    if not rows:
+        return
+    fingerprints = fingerprints or {}
+    now = time.time()
+    product_ids = [str(row['Id']) for row in rows]
+    with _products_lock:
+        conn = _products_db()
+        existing = _store_existing_ids(conn, product_ids)
+        next_position = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM products").fetchone()[0]
+        conn.executemany(
+            """INSERT INTO products (id, position, data, image_urls, fingerprint, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   data = excluded.data,
+                   image_urls = excluded.image_urls,
+                   fingerprint = excluded.fingerprint,
+                   updated_at = excluded.updated_at""",
+            [
+                (
+                    product_id, next_position + offset,
+                    json.dumps(row, ensure_ascii=False, default=str),
+                    _normalize_image_urls(row.get('ImageUrls')),
+                    fingerprints.get(product_id), now, now
+                )
+                for offset, (product_id, row) in enumerate(zip(product_ids, rows))
+            ]
+        )
+        _extend_store_columns(conn, rows)
+        appended = len(set(product_ids) - existing)
+        if appended:
+            _record_spreadsheet_change(conn, "appended", appended)
+        if len(rows) > appended:
+            _record_spreadsheet_change(conn, "updated", len(rows) - appended)
+        conn.commit()
+
+def product_store_update_images(image_updates):
+    """Обновляет списки изображений товаров одной транзакцией: {ID: строка ImageUrls}"""
+    if not image_updates:
+        return
+    now = time.time()
+    with _products_lock:
+        conn = _products_db()
+        conn.executemany(
+            "UPDATE products SET image_urls = ?, updated_at = ? WHERE id = ?",
+            [
+                (_normalize_image_urls(image_urls_string), now, str(product_id))
+                for product_id, image_urls_string in image_updates.items()
+            ]
+        )
+        _record_spreadsheet_change(conn, "images", len(image_updates))
+        conn.commit()
+
+def product_store_set_images(product_id, image_urls_string):
+    """Обновляет список изображений товара"""
+    product_store_update_images({product_id: image_urls_string})
+
+def product_store_set_fingerprints(fingerprints):
+    """Сохраняет отпечатки объявлений для существующих товаров"""
+    with _products_lock:
+        conn = _products_db()
+        conn.executemany(
+            "UPDATE products SET fingerprint = ? WHERE id = ?",
+            [(fingerprint, product_id) for product_id, fingerprint in fingerprints.items()]
+        )
+        conn.commit()
+
+def product_store_delete(product_ids):
+    """Удаляет товары из хранилища"""
+    with _products_lock:
+        conn = _products_db()
+        conn.executemany("DELETE FROM products WHERE id = ?", [(str(product_id),) for product_id in product_ids])
+        _record_spreadsheet_change(conn, "deleted", len(product_ids))
+        conn.commit()
+
+def _excel_value(value):
+    """Значение ячейки для выгрузки: пустые строки и NaN записываются пустыми ячейками"""
+    if value is None or value == "" or (isinstance(value, float) and pd.isna(value)):
+        return None
+    return value
+
+def export_products_to_excel(excel_path=OUTPUT_EXCEL_PATH):
+    """
+    Выгружает хранилище товаров в Excel-файл (атомарная замена файла).
+    Строки пишутся потоково (openpyxl в режиме write_only) прямо из курсора
+    хранилища, поэтому расход памяти не растет вместе с каталогом.
+    Первыми идут столбцы STANDARD_PARAMETERS, затем остальные в порядке появления
+    """
+    root_path, extension = os.path.splitext(excel_path)
+    tmp_path = f"{root_path}.tmp{extension}"
+    
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    row_count = 0
+    with _products_lock:
+        conn = _products_db()
+        stored_columns = _store_meta_get(conn, "columns", [])
+        columns = STANDARD_PARAMETERS + [column for column in stored_columns if column not in STANDARD_PARAMETERS]
+        
+        header = []
+        for column in columns:
+            cell = WriteOnlyCell(sheet, value=column)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        sheet.append(header)
+        
+        for data, image_urls in conn.execute("SELECT data, image_urls FROM products ORDER BY position"):
+            record = json.loads(data)
+            record['ImageUrls'] = image_urls
+            sheet.append([_excel_value(record.get(column)) for column in columns])
+            row_count += 1
+    
+    workbook.save(tmp_path)
+    os.replace(tmp_path, excel_path)
+    
+    with _products_lock:
+        conn = _products_db()
+        _store_meta_set(conn, "excel_sha256", file_digest(excel_path))
+        conn.commit()
+    print(f"Таблица выгружена из хранилища в {excel_path}, строк: {row_count}")
+    return excel_path
+
+def append_products(df, fingerprints=None):
+    """Добавляет в хранилище строки DataFrame с новыми Id, возвращает число добавленных"""
+    if 'Id' not in df.columns:
+        print("Отсутствует столбец 'Id' в новых данных, строки не могут быть сохранены")
+        return 0
+    
+    # Проверяем новые данные из df на отсутствие в хранилище по Id
+    existing_ids = product_store_ids()
+    new_rows = df[~df['Id'].astype(str).isin(existing_ids)]
+    if len(new_rows) == 0:
+        print("Нет новых строк для добавления")
+        return 0
+    
+    # Добавляем новые строки в конец таблицы
+    print(f"Добавление {len(new_rows)} новых строк к существующим {len(existing_ids)}")
+    product_store_upsert(new_rows.to_dict('records'), fingerprints)
+    return len(new_rows)
+
+def flush_spreadsheet(excel_path=OUTPUT_EXCEL_PATH):
+    """
+    Фиксирует накопленные изменения строк (удаления, изображения, обновления,
+    добавления): одна атомарная выгрузка таблицы и одно обновление файла на Google Drive.
+    Если изменений нет, возвращается ссылка на существующий файл.
+    Накопленные изменения сбрасываются только после успешной загрузки на Google Drive,
+    поэтому при ошибке загрузки таблица будет выгружена и загружена повторно.
+    
+    Returns:
+        tuple: (ссылка на таблицу или None при ошибке загрузки, была ли таблица обновлена)
+    """
+    changes = product_store_pending_changes()
+    
+    if not any(changes.values()) and os.path.exists(excel_path):
+        file_url = upload_to_google_drive(excel_path, force_update=False)
+        return file_url, False
+    if not any(changes.values()) and not product_store_ids():
+        return None, False
+    
+    export_products_to_excel(excel_path)
+    print(
+        f"Обновлен Excel-файл: добавлено {changes.get('appended', 0)}, изменено {changes.get('updated', 0)}, "
+        f"удалено {changes.get('deleted', 0)} товаров, обновлены изображения {changes.get('images', 0)} товаров"
+    )
+    
+    file_url = upload_to_google_drive(excel_path, force_update=True)
+    if not file_url:
+        print("Не удалось загрузить таблицу на Google Drive, изменения будут загружены при следующем запуске")
+        return None, True
+    
+    # Вычитаем загруженные изменения (новые могли появиться, пока шла загрузка)
+    with _products_lock:
+        conn = _products_db()
+        pending = _store_meta_get(conn, "pending_changes", {})
+        remaining = {kind: count - changes.get(kind, 0) for kind, count in pending.items()
+                     if count > changes.get(kind, 0)}
+        _store_meta_set(conn, "pending_changes", remaining)
+        conn.commit()
+    return file_url, True
+
+def xml_start_tag(element):
+    """Открывающий тег элемента с атрибутами и его текстом (для потоковой записи XML)"""
+    attributes = "".join(
+        f' {name}="{xml_escape(value, {chr(34): "&quot;", chr(10): "&#10;"})}"'
+        for name, value in element.attrib.items()
+    )
+    return f"<{element.tag}{attributes}>{xml_escape(element.text or '')}"
+
 def process_xml(use_gdrive_for_images=True):
-    """Обработка XML-файла и создание Excel-таблицы"""
+    """
+    Обработка XML-файла и создание Excel-таблицы
+    
+    Returns:
+        tuple: (DataFrame новых строк, ссылка на таблицу или None,
+                были ли изменения: добавленные, измененные или удаленные товары либо обновление таблицы)
+    """
     # Синхронизация с Google Drive
     sync_excel_from_gdrive()
     
     # Создание директории для изображений
     output_dir = create_output_dir()
     
+    # Декодируем оверлеи один раз за запуск
+    warm_overlay_cache()
+    
+    # Запускаем пулы параллельной обработки до начала сетевых операций
+    start_pools()
+    
     # Инициализация Google Drive API для изображений
     gdrive_service = None
     if use_gdrive_for_images:
         try:
-            credentials = service_account.Credentials.from_service_account_file(
-                GOOGLE_CRED_PATH, 
-                scopes=['https://www.googleapis.com/auth/drive']
-            )
-            gdrive_service = build('drive', 'v3', credentials=credentials)
+            gdrive_service = get_drive_service()
             print("Google Drive API инициализирован для загрузки изображений.")
         except Exception as e:
             print(f"Ошибка при инициализации Google Drive API: {e}")
             print("Изображения будут обработаны без загрузки на Google Drive.")
     
-    # Проверяем, существует ли уже файл Excel с данными
-    existing_ids = set()
-    existing_products_with_missing_images = {}
-    existing_data = None
-    
-    if os.path.exists(OUTPUT_EXCEL_PATH):
-        try:
-            # Загружаем существующие данные для определения ID товаров, которые уже обработаны
-            existing_data = pd.read_excel(OUTPUT_EXCEL_PATH)
-            print(f"Загружены существующие данные из {OUTPUT_EXCEL_PATH}, строк: {len(existing_data)}")
-            
-            if 'Id' in existing_data.columns:
-                # Получаем список существующих Id
-                existing_ids = set(existing_data['Id'].astype(str).tolist())
-                print(f"Найдено {len(existing_ids)} существующих товаров")
-                
-                # Проверяем наличие изображений в существующих товарах
-                if 'ImageUrls' in existing_data.columns:
-                    for index, row in existing_data.iterrows():
-                        product_id = str(row['Id'])
-                        image_urls = str(row['ImageUrls']) if pd.notna(row['ImageUrls']) else ""
-                        
-                        # Если у товара нет изображений, добавляем его в список для обработки
-                        if not image_urls or image_urls == "nan" or image_urls.strip() == "":
-                            existing_products_with_missing_images[product_id] = index
-                    
-                    if existing_products_with_missing_images:
-                        print(f"Найдено {len(existing_products_with_missing_images)} существующих товаров без изображений")
-                    else:
-                        print("Все существующие товары имеют изображения")
-        except Exception as e:
-            print(f"Ошибка при чтении существующего Excel-файла: {e}")
-    
-    # Парсинг XML
-    tree = ET.parse(LOCAL_XML_PATH)
-    root = tree.getroot()
-    
-    # Получаем список ID товаров из XML
-    xml_ids = set()
-    for ad in root.findall("Ad"):
-        ad_id_elem = ad.find("Id")
-        if ad_id_elem is not None and ad_id_elem.text is not None:
-            xml_ids.add(ad_id_elem.text)
-    
-    # Проверяем, какие товары из Excel отсутствуют в XML
-    if existing_data is not None and len(existing_ids) > 0:
-        removed_ids = existing_ids - xml_ids
-        if removed_ids:
-            print(f"Найдено {len(removed_ids)} товаров, которые были удалены из XML:")
-            for removed_id in removed_ids:
-                print(f"- {removed_id}")
-            
-            # Удаляем строки с отсутствующими товарами
-            existing_data = existing_data[~existing_data['Id'].astype(str).isin(removed_ids)]
-            print(f"Удалено {len(removed_ids)} товаров из Excel-таблицы")
-            
-            # Сохраняем обновленную таблицу
-            existing_data.to_excel(OUTPUT_EXCEL_PATH, index=False)
-            print(f"Обновленная таблица сохранена в {OUTPUT_EXCEL_PATH}")
-            
-            # Загружаем обновленную таблицу на Google Drive
-            file_url = upload_to_google_drive(OUTPUT_EXCEL_PATH, force_update=True)
-            print(f"Обновленная таблица загружена на Google Drive")
-    
-    # Ищем и удаляем нежелательный текст в описаниях
-    print("Ищем и удаляем нежелательный текст в описаниях...")
-    unwanted_suffix = "</p><p>__________________________<br />Режим работы : 9.00-19.00<br />Отправляем всеми ТК СДЕК BOXBERRY Яндекс Почта России DPD Авито <br />Максимально упаковываем товар перед отправкой</p>"
-    for ad in root.findall("Ad"):
-        description = ad.find("Description")
-        if description is not None and description.text:
-            if description.text.endswith(unwanted_suffix):
-                description.text = description.text[:-len(unwanted_suffix)]
-                print(f"Удален нежелательный текст из описания товара {ad.find('Id').text if ad.find('Id') is not None else 'без ID'}")
-            elif "</p><p>__________________________<br />" in description.text:
-                # Находим начало нежелательного текста
-                start_idx = description.text.find("</p><p>__________________________<br />")
-                if start_idx != -1:
-                    # Удаляем весь текст с этого места до конца
-                    description.text = description.text[:start_idx] + "</p>"
-                    print(f"Удален частичный нежелательный текст из описания товара {ad.find('Id').text if ad.find('Id') is not None else 'без ID'}")
-    
-    # Сбор всех возможных параметров из ВСЕХ объявлений XML (не только тех, которые будут обрабатываться)
-    all_parameters = set()
-    print("Сбор всех возможных параметров из объявлений...")
-    for ad in root.findall("Ad"):
-        for elem in ad:
-            all_parameters.add(elem.tag)
-    
-    print(f"Найдено {len(all_parameters)} уникальных параметров в XML")
-    
-    # Список стандартных параметров, которые всегда должны быть
-    standard_parameters = [
-        "Id", "AdType", "Category", "Address", "ContactPhone", 
-        "GoodsType", "ProductType", "SparePartType", "Title", 
-        "Description", "Price", "Availability", "Condition", "Brand", "OEM",
-        "TechnicSparePartType", "TransmissionSparePartType", "EngineSparePartType"
-    ]
+    # Таблица, измененная вне программы (например, на Google Drive), загружается в хранилище товаров
+    sync_products_from_excel()
     
-    # Добавляем стандартные параметры, которых может не быть в XML
-    for param in standard_parameters:
-        all_parameters.add(param)
+    # Получаем список существующих товаров и товаров без изображений из хранилища
+    existing_ids = product_store_ids()
+    existing_products_with_missing_images = product_store_missing_images()
+    if existing_ids:
+        print(f"Найдено {len(existing_ids)} существующих товаров")
+        if existing_products_with_missing_images:
+            print(f"Найдено {len(existing_products_with_missing_images)} существующих товаров без изображений")
+        else:
+            print("Все существующие товары имеют изображения")
     
-    # Добавляем наши кастомные параметры
+    # Все возможные параметры: стандартные, наши кастомные и все теги из объявлений XML.
+    # Набор пополняется по мере чтения объявлений
+    all_parameters = set(STANDARD_PARAMETERS)
     all_parameters.add("InternetCalls")
     all_parameters.add("CallsDevices")
     all_parameters.add("ImageUrls")
     
-    # Удаляем поле Images из параметров, так как оно не нужно в Excel
-    if "Images" in all_parameters:
-        all_parameters.remove("Images")
-        print("Удалено поле Images из списка параметров")
+    # Список ID товаров из XML
+    xml_ids = set()
     
-    print(f"Итоговое количество параметров с учетом стандартных и кастомных: {len(all_parameters)}")
+    # Отпечатки объявлений: по ним определяем добавленные, измененные и неизменные товары
+    previous_fingerprints = product_store_fingerprints()
+    current_fingerprints = {}
+    changeset = {"added": [], "changed": [], "removed": [], "unchanged": 0}
     
     # Данные для таблицы
     data = []
+    image_updates = {}  # Изображения для существующих товаров: {ID: строка ImageUrls}
+    changed_rows = {}  # Новые данные измененных товаров: {ID: строка}
+    changed_fingerprints = {}
     processed_images_dict = {}  # Словарь для хранения путей к обработанным изображениям
+    image_failed_ids = set()  # Товары, изображения которых не удалось получить
+    image_ok_ids = set()
     
     # Счетчик обработанных товаров
     processed_count = 0
     skipped_count = 0
     
-    # Обработка каждого объявления с ограничением
-    for ad in root.findall("Ad"):
-        ad_id_elem = ad.find("Id")
-        
-        # Проверяем наличие элемента Id
-        if ad_id_elem is None or ad_id_elem.text is None:
-            continue
+    # Изображения объявлений обрабатываются параллельно в пуле потоков (или в асинхронном конвейере).
+    # Объявления проходят через ограниченное окно и записываются в выходной XML
+    # строго в исходном порядке, после чего освобождаются из памяти
+    if IMAGE_PIPELINE == "async" and not async_pipeline_enabled():
+        print("aiohttp не установлен, изображения обрабатываются в пуле потоков")
+    pending_ads = deque()  # (вид обработки, элемент объявления, ID, отпечаток, future)
+    window_size = ASYNC_AD_WINDOW if async_pipeline_enabled() else AD_WORKERS * 2
+    
+    output_xml_path = "avito_processed.xml"
+    tmp_xml_path = f"{output_xml_path}.tmp"
+    xml_writer = None
+    
+    def finalize_ad(kind, ad, ad_id, fingerprint, future):
+        """Применяет результат обработки объявления и записывает его в выходной XML"""
+        if future is not None:
+            try:
+                processed_images = future.result()
+            except Exception as e:
+                print(f"Ошибка при обработке изображений для {ad_id}: {e}")
+                import traceback
+                traceback.print_exc()
+                processed_images = []
             
-        ad_id = ad_id_elem.text
-        
-        # Проверяем, является ли этот товар существующим товаром без изображений
-        if ad_id in existing_products_with_missing_images:
-            print(f"Товар {ad_id} уже существует в таблице, но не имеет изображений. Добавляем изображения.")
-            # Обработка изображений
-            processed_images = process_images(ad, output_dir, ad_id, gdrive_service)
-            if processed_images:
+            if kind == "fix":
+                if processed_images:
+                    # Формируем строку со всеми URL изображений, разделенными |
+                    image_urls_string = "|".join(processed_images)
+                    
+                    # Обновление записи в хранилище выполняется одним пакетом после прохода
+                    image_updates[ad_id] = image_urls_string
+                    print(f"Добавлены изображения для товара {ad_id}")
+                    
+                    # Если есть секция Images, заменяем её в XML
+                    replace_xml_images(ad, processed_images)
+            elif kind == "changed":
+                # Измененный товар: перезаписываем его строку в существующей таблице
+                if processed_images:
+                    replace_xml_images(ad, processed_images)
+                row_data = build_row_data(ad, all_parameters, "|".join(processed_images))
+                if processed_images:
+                    changed_fingerprints[ad_id] = fingerprint
+                else:
+                    # Изображения не получены - сохраняем ссылки, уже записанные в таблице,
+                    # и прежний отпечаток, чтобы при следующем запуске повторить обработку
+                    row_data.pop("ImageUrls", None)
+                    changed_fingerprints[ad_id] = previous_fingerprints.get(ad_id)
+                changed_rows[ad_id] = row_data
+                print(f"Обновлена строка измененного товара {ad_id}")
+            else:
+                processed_images_dict[ad_id] = processed_images
+                
+                # Если есть секция Images, заменяем её в XML
+                if processed_images:
+                    replace_xml_images(ad, processed_images)
+                
                 # Формируем строку со всеми URL изображений, разделенными |
                 image_urls_string = "|".join(processed_images)
                 
-                # Обновляем запись в существующем DataFrame
-                row_index = existing_products_with_missing_images[ad_id]
-                existing_data.at[row_index, 'ImageUrls'] = image_urls_string
-                print(f"Добавлены изображения для товара {ad_id}")
-                
-                # Если есть секция Images, заменяем её в XML
-                images_element = ad.find("Images")
-                if images_element is not None:
-                    # Удаляем существующие изображения
-                    for img in images_element.findall("Image"):
-                        images_element.remove(img)
-                        
-                    # Добавляем новые изображения в XML
-                    for i, img_path in enumerate(processed_images):
-                        # Получаем соответствующий URL
-                        img_url = img_path if isinstance(img_path, str) else img_path[0]
-                        
-                        # Создаём элемент для XML
-                        img_elem = ET.SubElement(images_element, "Image")
-                        img_elem.text = img_url
-                        img_elem.set("url", img_url)
-            continue
-        
-        # Обрабатываем только товары начинающиеся с "bz" и с ограничением на количество
-        if not ad_id.startswith("bz") or processed_count >= MAX_ITEMS:
-            continue
-        
-        # Пропускаем уже существующие товары (кроме тех, которые нуждаются в добавлении изображений)
-        if ad_id in existing_ids and ad_id not in existing_products_with_missing_images:
-            skipped_count += 1
-            print(f"Пропуск объявления {ad_id} (уже существует в таблице)")
-            continue
-            
-        processed_count += 1
-        print(f"Обработка объявления {ad_id} ({processed_count}/{MAX_ITEMS - skipped_count})")
+                data.append(build_row_data(ad, all_parameters, image_urls_string))
         
-        # Замена описания
-        description = ad.find("Description")
-        if description is not None and description.text:
-            print(f"Обработка описания для {ad_id}")
-            # Проверяем, содержит ли текст CDATA
-            if "<![CDATA[" in description.text and "]]>" in description.text:
-                # Извлекаем содержимое CDATA
-                cdata_start = description.text.find("<![CDATA[") + 9
-                cdata_end = description.text.rfind("]]>")
-                cdata_content = description.text[cdata_start:cdata_end]
-                
-                # Ищем маркер "Lada;"
-                lada_index = cdata_content.find("Lada;")
-                if lada_index != -1:
-                    print(f"Найден маркер 'Lada;' в позиции {lada_index}")
-                    # Всегда вставляем описание сразу после "Lada;"
-                    new_cdata_content = cdata_content[:lada_index + 5] + NEW_DESCRIPTION + cdata_content[lada_index + 5:]
-                    description.text = f"<![CDATA[{new_cdata_content}]]>"
-                    print("Описание успешно вставлено после 'Lada;'")
-                else:
-                    # Если нет "Lada;", ищем последний </p><p>
-                    last_p_tag = cdata_content.rfind("</p><p>")
-                    if last_p_tag != -1:
-                        print(f"Найден тег </p><p> в позиции {last_p_tag}")
-                        # Вставляем после последнего тега </p><p>
-                        tag_end = last_p_tag + len("</p><p>")
-                        new_cdata_content = cdata_content[:tag_end] + NEW_DESCRIPTION + cdata_content[tag_end:]
-                        description.text = f"<![CDATA[{new_cdata_content}]]>"
-                        print("Описание успешно вставлено после тега </p><p>")
-                    else:
-                        print("Не найдены ни 'Lada;', ни </p><p>. Добавление в конец.")
-                        # Если нет тегов, вставляем в конец
-                        description.text = f"<![CDATA[{cdata_content}{NEW_DESCRIPTION}]]>"
+            if not processed_images:
+                # Изображения не получены - товар будет обработан снова (не раньше, чем через
+                # IMAGE_RETRY_INTERVAL_MINUTES, если XML-файл не изменится)
+                fingerprint = None
+                image_failed_ids.add(ad_id)
             else:
-                print("Текст не содержит CDATA")
-                # Если нет CDATA, просто добавляем описание в конец
-                lada_index = description.text.find("Lada;")
-                if lada_index != -1:
-                    print(f"Найден маркер 'Lada;' в позиции {lada_index}")
-                    # Вставляем описание сразу после "Lada;"
-                    # Уже закодированное в исходном файле описание
-                    description.text = description.text[:lada_index + 5] + NEW_DESCRIPTION + description.text[lada_index + 5:]
-                    print("Описание успешно вставлено после 'Lada;'")
-                else:
-                    print("Добавление описания в конец")
-                    # Если нет "Lada;", добавляем в конец
-                    description.text = description.text + NEW_DESCRIPTION
-        
-        # Обработка изображений
-        processed_images = process_images(ad, output_dir, ad_id, gdrive_service)
-        processed_images_dict[ad_id] = processed_images
-        
-        # Если есть секция Images, заменяем её в XML
-        if processed_images:
-            images_element = ad.find("Images")
-            if images_element is not None:
-                # Удаляем существующие изображения
-                for img in images_element.findall("Image"):
-                    images_element.remove(img)
-                    
-                # Добавляем новые изображения в XML
-                for i, img_path in enumerate(processed_images):
-                    # Получаем соответствующий URL
-                    img_url = img_path if isinstance(img_path, str) else img_path[0]
-                    
-                    # Создаём элемент для XML
-                    img_elem = ET.SubElement(images_element, "Image")
-                    img_elem.text = img_url
-                    img_elem.set("url", img_url)
-        
-        # Формируем строку со всеми URL изображений, разделенными |
-        image_urls_string = "|".join(processed_images)
-        
-        # Собираем данные для Excel
-        row_data = {
-            # Указываем пустое значение для всех возможных параметров
-            param: "" for param in all_parameters
-        }
+                image_ok_ids.add(ad_id)
         
-        # Заполняем значения из объявления
-        for elem in ad:
-            if elem.tag in row_data and elem.text is not None:
-                # Очищаем CDATA если есть
-                if "<![CDATA[" in elem.text and "]]>" in elem.text:
-                    cdata_start = elem.text.find("<![CDATA[") + 9
-                    cdata_end = elem.text.rfind("]]>")
-                    row_data[elem.tag] = elem.text[cdata_start:cdata_end]
-                else:
-                    row_data[elem.tag] = elem.text
-        
-        # Добавляем наши кастомные значения
-        row_data["InternetCalls"] = "Да"
-        row_data["CallsDevices"] = "3889715587"
-        row_data["ImageUrls"] = image_urls_string
+        if ad_id is not None and fingerprint is not None:
+            current_fingerprints[ad_id] = fingerprint
         
-        data.append(row_data)
-    
-    # Сохраняем обновленный XML
-    output_xml_path = "avito_processed.xml"
-    tree.write(output_xml_path, encoding="utf-8", xml_declaration=True)
-    print(f"Обработанный XML сохранен: {output_xml_path}")
+        xml_writer.write(ET.tostring(ad, encoding="unicode"))
+        ad.clear()
     
-    # Проверяем, были ли обновлены существующие товары с отсутствующими изображениями
-    if existing_products_with_missing_images and os.path.exists(OUTPUT_EXCEL_PATH):
-        # Сохраняем обновленный DataFrame с добавленными изображениями
-        existing_data.to_excel(OUTPUT_EXCEL_PATH, index=False)
-        print(f"Обновлен Excel-файл с добавленными изображениями для {len(existing_products_with_missing_images)} товаров")
-        
-        # Загружаем файл на Google Drive
-        file_url = upload_to_google_drive(OUTPUT_EXCEL_PATH, force_update=True)
-        print(f"Обновленная таблица загружена на Google Drive")
-        
-        if not data:  # Если нет новых товаров для добавления
-            return pd.DataFrame(), file_url
+    print("Потоковая обработка объявлений из XML...")
+    unwanted_suffix = "</p><p>__________________________<br />Режим работы : 9.00-19.00<br />Отправляем всеми ТК СДЕК BOXBERRY Яндекс Почта России DPD Авито <br />Максимально упаковываем товар перед отправкой</p>"
     
-    if not data:
-        print("Нет новых товаров для добавления")
-        
-        # Возвращаем существующую ссылку если нет новых товаров
-        file_url = None
-        if os.path.exists(OUTPUT_EXCEL_PATH):
-            # Проверяем, есть ли файл на Google Drive
-            try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    GOOGLE_CRED_PATH, 
-                    scopes=['https://www.googleapis.com/auth/drive']
-                )
-                drive_service = build('drive', 'v3', credentials=credentials)
-                
-                # Название файла в Google Drive
-                file_name = os.path.basename(OUTPUT_EXCEL_PATH)
+    root = None
+    depth = 0
+    try:
+        for event, elem in ET.iterparse(LOCAL_XML_PATH, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            
+            depth -= 1
+            if depth != 1:
+                continue
+            
+            ad = elem
+            # Объявление больше не нужно корневому элементу - держим его только в окне
+            root.remove(ad)
+            
+            if xml_writer is None:
+                # Заголовок выходного XML пишем, когда уже известен текст корневого элемента
+                xml_writer = open(tmp_xml_path, 'w', encoding='utf-8')
+                xml_writer.write("<?xml version='1.0' encoding='utf-8'?>\n")
+                xml_writer.write(xml_start_tag(root))
+            
+            if ad.tag != "Ad":
+                # Прочие элементы корня переносятся в выходной XML без изменений, в исходном порядке
+                pending_ads.append((None, ad, None, None, None))
+                continue
+            
+            # Сбор всех возможных параметров из ВСЕХ объявлений XML
+            for child in ad:
+                if child.tag != "Images":  # Поле Images не нужно в Excel
+                    all_parameters.add(child.tag)
+            
+            ad_id_elem = ad.find("Id")
+            ad_id = ad_id_elem.text if ad_id_elem is not None else None
+            fingerprint = None
+            content_changed = False
+            if ad_id is not None:
+                xml_ids.add(ad_id)
+                # Отпечаток считаем до любых изменений объявления.
+                # Для товаров без сохраненного отпечатка (первый запуск) он просто запоминается
+                fingerprint = ad_fingerprint(ad)
+                content_changed = previous_fingerprints.get(ad_id, fingerprint) != fingerprint
+            
+            # Ищем и удаляем нежелательный текст в описании
+            description = ad.find("Description")
+            if description is not None and description.text:
+                if description.text.endswith(unwanted_suffix):
+                    description.text = description.text[:-len(unwanted_suffix)]
+                    print(f"Удален нежелательный текст из описания товара {ad_id if ad_id is not None else 'без ID'}")
+                elif "</p><p>__________________________<br />" in description.text:
+                    # Находим начало нежелательного текста
+                    start_idx = description.text.find("</p><p>__________________________<br />")
+                    if start_idx != -1:
+                        # Удаляем весь текст с этого места до конца
+                        description.text = description.text[:start_idx] + "</p>"
+                        print(f"Удален частичный нежелательный текст из описания товара {ad_id if ad_id is not None else 'без ID'}")
+            
+            kind, future = None, None
+            
+            # Проверяем наличие элемента Id
+            if ad_id is None:
+                pass
+            # Проверяем, является ли этот товар существующим товаром без изображений.
+            # Если объявление при этом изменилось, оно обрабатывается целиком как измененное
+            elif ad_id in existing_products_with_missing_images and not content_changed:
+                print(f"Товар {ad_id} уже существует в таблице, но не имеет изображений. Добавляем изображения.")
+                # Обработка изображений
+                kind = "fix"
+                future = submit_ad_images(ad, output_dir, ad_id, gdrive_service)
+            # Обрабатываем только товары начинающиеся с "bz" и с ограничением на количество
+            elif ad_id not in existing_products_with_missing_images and (
+                    not ad_id.startswith("bz") or processed_count >= MAX_ITEMS):
+                pass
+            # Пропускаем уже существующие товары, если они не изменились с прошлого запуска
+            elif ad_id in existing_ids and not content_changed:
+                skipped_count += 1
+                changeset["unchanged"] += 1
+                print(f"Пропуск объявления {ad_id} (уже существует в таблице и не изменился)")
+            else:
+                processed_count += 1
+                kind = "changed" if ad_id in existing_ids else "new"
+                changeset[kind if kind == "changed" else "added"].append(ad_id)
+                print(f"Обработка {'измененного ' if kind == 'changed' else ''}объявления {ad_id} ({processed_count}/{MAX_ITEMS - skipped_count})")
                 
-                # Проверка, существует ли файл с таким именем
-                response = drive_service.files().list(
-                    q=f"name='{file_name}' and trashed=false",
-                    spaces='drive',
-                    fields='files(id, name)'
-                ).execute()
+                # Замена описания
+                replace_description(ad, ad_id)
                 
-                if response.get('files'):
-                    file_id = response.get('files')[0].get('id')
-                    file_url = f"https://docs.google.com/spreadsheets/d/{file_id}/edit?usp=sharing"
-            except Exception as e:
-                print(f"Ошибка при получении ссылки на документ: {e}")
-        
-        if file_url:
-            return pd.DataFrame(), file_url
-        else:
-            return pd.DataFrame(), None
+                # Обработка изображений
+                future = submit_ad_images(ad, output_dir, ad_id, gdrive_service)
+            
+            pending_ads.append((kind, ad, ad_id, fingerprint, future))
+            
+            # Окно заполнено - завершаем самое старое объявление
+            while len(pending_ads) > window_size:
+                finalize_ad(*pending_ads.popleft())
+        
+        # Завершаем оставшиеся объявления
+        while pending_ads:
+            finalize_ad(*pending_ads.popleft())
+        
+        if xml_writer is None:
+            xml_writer = open(tmp_xml_path, 'w', encoding='utf-8')
+            xml_writer.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            xml_writer.write(xml_start_tag(root))
+        xml_writer.write(f"</{root.tag}>")
+    finally:
+        if xml_writer is not None:
+            xml_writer.close()
+    
+    # Сохраняем обработанный XML
+    os.replace(tmp_xml_path, output_xml_path)
+    print(f"Обработанный XML сохранен: {output_xml_path}")
+    print(f"Найдено {len(all_parameters)} параметров с учетом стандартных и кастомных")
+    
+    # Выдаем права доступа файлам, загруженным вне общей папки
+    flush_public_access(gdrive_service)
+    
+    # Изменения существующих товаров записываем в хранилище пакетами, по одной транзакции:
+    # измененные строки объединяются с сохраненными по Id, изображения обновляются одним запросом
+    if changed_rows:
+        stored_rows = product_store_get_many(changed_rows)
+        product_store_upsert(
+            [{**stored_rows.get(ad_id, {}), **row_data} for ad_id, row_data in changed_rows.items()],
+            changed_fingerprints
+        )
+    product_store_update_images(image_updates)
+    
+    # Сохраняем отпечатки существующих товаров (новым они записываются при добавлении строк)
+    product_store_set_fingerprints(current_fingerprints)
     
-    # Создаем DataFrame для предварительного просмотра
-    df = pd.DataFrame(data)
+    # Проверяем, какие товары из Excel отсутствуют в XML
+    if existing_ids:
+        removed_ids = existing_ids - xml_ids
+        changeset["removed"] = sorted(removed_ids)
+        if removed_ids:
+            print(f"Найдено {len(removed_ids)} товаров, которые были удалены из XML:")
+            for removed_id in removed_ids:
+                print(f"- {removed_id}")
+            
+            # Удаляем строки с отсутствующими товарами
+            product_store_delete(removed_ids)
+            print(f"Удалено {len(removed_ids)} товаров из Excel-таблицы")
     
-    # Выводим информацию о созданном DataFrame
-    print(f"Создан DataFrame с {len(df)} строками и {len(df.columns)} столбцами")
-    print("Столбцы в DataFrame:")
-    for i, col in enumerate(df.columns):
-        print(f"{i+1}. {col}")
+    print(
+        f"Изменения в XML: добавлено {len(changeset['added'])}, изменено {len(changeset['changed'])}, "
+        f"удалено {len(changeset['removed'])}, без изменений {changeset['unchanged']}"
+    )
     
-    # Проверяем, есть ли в DataFrame нужные столбцы
-    for param in standard_parameters:
-        if param not in df.columns:
-            print(f"Внимание: Столбец '{param}' отсутствует в DataFrame! Добавляем его...")
-            df[param] = ""  # Добавляем пустой столбец
+    df = pd.DataFrame()
+    if not data:
+        print("Нет новых товаров для добавления")
+    else:
+        # Создаем DataFrame для предварительного просмотра. Параметры, найденные
+        # в более поздних объявлениях, заполняем пустыми значениями и в ранних строках
+        df = pd.DataFrame(data).reindex(columns=list(all_parameters)).fillna("")
+        
+        # Выводим информацию о созданном DataFrame
+        print(f"Создан DataFrame с {len(df)} строками и {len(df.columns)} столбцами")
+        print("Столбцы в DataFrame:")
+        for i, col in enumerate(df.columns):
+            print(f"{i+1}. {col}")
+        
+        # Проверяем, есть ли в DataFrame нужные столбцы
+        for param in STANDARD_PARAMETERS:
+            if param not in df.columns:
+                print(f"Внимание: Столбец '{param}' отсутствует в DataFrame! Добавляем его...")
+                df[param] = ""  # Добавляем пустой столбец
+        
+        # Новые строки добавляются в хранилище, таблица выгружается ниже
+        append_products(df, fingerprints=current_fingerprints)
     
-    # Создаем Excel-файл без вставки изображений, только ссылки
-    excel_path, was_updated = save_to_excel(df)
+    # Для товаров, изображения которых не удалось получить, назначаем время повторной попытки
+    product_store_schedule_image_retry(image_failed_ids, image_ok_ids)
     
-    # Загружаем файл на Google Drive только если он был обновлен
-    if was_updated:
-        file_url = upload_to_google_drive(excel_path, force_update=True)
+    # Все изменения цикла (удаления, изображения, изменения, новые строки)
+    # записываются в таблицу и загружаются на Google Drive один раз
+    file_url, was_updated = flush_spreadsheet(OUTPUT_EXCEL_PATH)
+    if not file_url:
+        print(f"Таблица не загружена на Google Drive")
+    elif was_updated:
         print(f"Таблица обновлена и загружена на Google Drive")
     else:
-        # Если файл не был обновлен, получаем существующую ссылку
-        file_url = upload_to_google_drive(excel_path, force_update=False)
         print(f"Таблица не изменилась, используем существующую ссылку")
     
-    return df, file_url
+    changed = was_updated or any(changeset[kind] for kind in ("added", "changed", "removed"))
+    return df, file_url, changed
 
 # Создаем алиас для запуска с Google Drive для изображений
 def process_xml_with_gdrive():
@@ -1104,24 +2985,17 @@ def add_image(product_id, image_url, output_dir=None, gdrive_service=None):
         output_dir = create_output_dir()
         
     try:
-        # Загружаем существующую таблицу
-        if not os.path.exists(OUTPUT_EXCEL_PATH):
-            print(f"Файл {OUTPUT_EXCEL_PATH} не найден")
-            return False
-            
-        existing_data = pd.read_excel(OUTPUT_EXCEL_PATH)
+        # Подтягиваем в хранилище изменения таблицы, сделанные вне программы
+        sync_products_from_excel()
         
         # Ищем товар по ID
-        product_mask = existing_data['Id'] == product_id
-        if not any(product_mask):
+        product = product_store_get(product_id)
+        if product is None:
             print(f"Товар с ID {product_id} не найден в таблице")
             return False
-            
-        product_index = existing_data.index[product_mask][0]
         
         # Получаем текущие URL изображений
-        current_images = existing_data.at[product_index, 'ImageUrls']
-        current_images = str(current_images) if pd.notna(current_images) else ""
+        current_images = product['ImageUrls']
         
         # Обрабатываем новое изображение
         try:
@@ -1130,6 +3004,7 @@ def add_image(product_id, image_url, output_dir=None, gdrive_service=None):
             
             # Обрабатываем изображения
             processed_images = process_image_urls(image_urls, output_dir, product_id, gdrive_service)
+            flush_public_access(gdrive_service)
             
             if not processed_images:
                 print(f"Не удалось обработать изображение {image_url}")
@@ -1139,8 +3014,8 @@ def add_image(product_id, image_url, output_dir=None, gdrive_service=None):
             processed_url = processed_images[0]
             
             # Если у товара еще нет изображений, просто добавляем новое
-            if not current_images or current_images == "nan" or current_images.strip() == "":
-                existing_data.at[product_index, 'ImageUrls'] = processed_url
+            if not current_images:
+                product_store_set_images(product_id, processed_url)
             else:
                 # Добавляем новое изображение к существующим
                 image_list = current_images.split("|")
@@ -1148,15 +3023,14 @@ def add_image(product_id, image_url, output_dir=None, gdrive_service=None):
                 # Проверяем, не дублируется ли URL (это может быть, если изображение уже было добавлено)
                 if processed_url not in image_list:
                     image_list.append(processed_url)
-                    existing_data.at[product_index, 'ImageUrls'] = "|".join(image_list)
+                    product_store_set_images(product_id, "|".join(image_list))
                 else:
                     print(f"Изображение {processed_url} уже существует для товара {product_id}")
             
-            # Сохраняем обновленные данные обратно в Excel
-            existing_data.to_excel(OUTPUT_EXCEL_PATH, index=False)
-            
-            # Обновляем файл на Google Drive
-            upload_to_google_drive(OUTPUT_EXCEL_PATH)
+            # Выгружаем обновленные данные в Excel и обновляем файл на Google Drive
+            file_url, _ = flush_spreadsheet(OUTPUT_EXCEL_PATH)
+            if not file_url:
+                print(f"Таблица сохранена локально, загрузка на Google Drive будет повторена при следующем запуске")
             
             print(f"Изображение успешно добавлено к товару {product_id}")
             return True
@@ -1169,30 +3043,354 @@ def add_image(product_id, image_url, output_dir=None, gdrive_service=None):
         print(f"Ошибка при добавлении изображения к товару {product_id}: {e}")
         return False
 
+def _drive_file_id(url):
+    """ID файла Google Drive из ссылки вида https://drive.google.com/uc?export=view&id=..."""
+    if not url.startswith("https://drive.google.com/"):
+        return None
+    return parse_qs(urlparse(url).query).get("id", [None])[0]
+
+def _remove_file(file_path, report, kind):
+    """
+    Удаляет файл и учитывает его размер в отчете об очистке. Размер учитывается,
+    только если это последнее имя файла: данные файла с другой жесткой ссылкой
+    (копия в processed_images и файл кэша) остаются на диске
+    """
+    try:
+        file_stat = os.stat(file_path)
+        os.remove(file_path)
+    except OSError as e:
+        print(f"Не удалось удалить {file_path}: {e}")
+        return
+    report[f"{kind}_files"] += 1
+    if file_stat.st_nlink == 1:
+        report[f"{kind}_bytes"] += file_stat.st_size
+
+def _gc_processed_images(output_dir, live_ids, live_paths, report):
+    """
+    Удаляет из output_dir изображения удаленных товаров, а также копии старше GC_MAX_AGE_DAYS,
+    на которые не ссылается таблица (при работе с Google Drive таблица содержит ссылки на Drive)
+    """
+    now = time.time()
+    for entry in os.scandir(output_dir):
+        if not entry.is_file():
+            continue
+        age = now - entry.stat().st_mtime
+        if entry.name.endswith(".tmp"):
+            if age > GC_TMP_MAX_AGE:
+                _remove_file(entry.path, report, "local")
+            continue
+        if os.path.normpath(entry.path) in live_paths or entry.name.startswith("shop_"):
+            continue
+        ad_id = entry.name.rsplit("_", 1)[0]
+        if ad_id not in live_ids or age > GC_MAX_AGE_DAYS * 86400:
+            _remove_file(entry.path, report, "local")
+
+def _gc_image_cache(live_drive_urls, deleted_drive_urls, report):
+    """
+    Чистит кэш обработанных изображений: удаляет устаревшие записи, ссылки на удаленные
+    файлы Google Drive, укладывает файлы кэша в бюджет GC_MAX_CACHE_BYTES и удаляет
+    файлы, на которые не ссылается ни одна запись
+    """
+    expired_before = time.time() - GC_MAX_AGE_DAYS * 86400
+    with _image_cache_lock:
+        conn = _image_cache_db()
+        if deleted_drive_urls:
+            conn.executemany("UPDATE images SET drive_url = NULL WHERE drive_url = ?",
+                             [(url,) for url in deleted_drive_urls])
+        
+        # Старые записи оставляем, только если их ссылка есть в таблице или файл
+        # еще используется в processed_images (жесткая ссылка на файл кэша)
+        rows = conn.execute(
+            "SELECT cache_key, blob, drive_url, updated_at FROM images ORDER BY updated_at"
+        ).fetchall()
+        drop_keys, blob_sizes, kept = [], {}, []
+        for cache_key, blob, drive_url, updated_at in rows:
+            blob_path = image_cache_blob_path(blob) if blob else None
+            try:
+                blob_stat = os.stat(blob_path) if blob_path else None
+            except OSError:
+                blob_stat = None
+            if (updated_at or 0) < expired_before and drive_url not in live_drive_urls and (
+                    blob_stat is None or blob_stat.st_nlink < 2):
+                drop_keys.append(cache_key)
+                continue
+            if not blob_stat and not drive_url:
+                drop_keys.append(cache_key)
+                continue
+            if blob_stat and blob_stat.st_nlink == 1:
+                # В бюджете учитываются только файлы, которые есть лишь в кэше: удаление
+                # файла с жесткой ссылкой в processed_images место на диске не освобождает
+                blob_sizes[blob] = blob_stat.st_size
+            kept.append((cache_key, blob if blob_stat else None, drive_url))
+        
+        # Бюджет размера: вытесняем самые старые записи. Запись со ссылкой на Google Drive
+        # остается рабочей и без файла, поэтому у нее удаляется только файл
+        total_size = sum(blob_sizes.values())
+        detach_keys = []
+        blob_users = {}
+        for cache_key, blob, drive_url in kept:
+            if blob:
+                blob_users[blob] = blob_users.get(blob, 0) + 1
+        for cache_key, blob, drive_url in kept:
+            if total_size <= GC_MAX_CACHE_BYTES:
+                break
+            if blob not in blob_sizes:
+                continue
+            if drive_url:
+                detach_keys.append(cache_key)
+            else:
+                drop_keys.append(cache_key)
+            blob_users[blob] -= 1
+            if not blob_users[blob]:
+                total_size -= blob_sizes[blob]
+        
+        conn.executemany("DELETE FROM images WHERE cache_key = ?", [(key,) for key in drop_keys])
+        conn.executemany("UPDATE images SET blob = NULL WHERE cache_key = ?", [(key,) for key in detach_keys])
+        conn.execute("DELETE FROM images WHERE blob IS NULL AND drive_url IS NULL")
+        conn.commit()
+        report["cache_entries"] += len(drop_keys)
+        used_blobs = {row[0] for row in conn.execute("SELECT blob FROM images WHERE blob IS NOT NULL")}
+    
+    now = time.time()
+    for root, _, files in os.walk(IMAGE_CACHE_DIR):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if name.endswith(".tmp"):
+                try:
+                    if now - os.path.getmtime(file_path) > GC_TMP_MAX_AGE:
+                        _remove_file(file_path, report, "cache")
+                except OSError:
+                    pass
+            elif os.path.splitext(name)[0] not in used_blobs:
+                _remove_file(file_path, report, "cache")
+
+def _gc_drive_images(drive_service, live_file_ids, report):
+    """
+    Удаляет из папки изображений на Google Drive файлы, на которые не ссылаются
+    ни таблица, ни фото магазина. Удаление выполняется пакетными запросами.
+    Возвращает множество ссылок на удаленные файлы
+    """
+    folder_id = get_drive_state("folders", IMAGES_FOLDER_NAME)
+    if not folder_id:
+        return set()
+    
+    grace_before = datetime.utcnow() - timedelta(hours=GC_DRIVE_GRACE_HOURS)
+    orphan_ids = []
+    orphan_sizes = {}
+    page_token = None
+    while True:
+        response = drive_service.files().list(
+            q=f"'{folder_id}' in parents and trashed=false",
+            spaces='drive',
+            fields='nextPageToken, files(id, createdTime, size)',
+            pageSize=1000,
+            pageToken=page_token
+        ).execute()
+        for file in response.get('files', []):
+            created = datetime.strptime(file['createdTime'][:19], "%Y-%m-%dT%H:%M:%S")
+            if file['id'] not in live_file_ids and created < grace_before:
+                orphan_ids.append(file['id'])
+                orphan_sizes[file['id']] = int(file.get('size', 0))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    
+    if not orphan_ids:
+        return set()
+    print(f"Удаление {len(orphan_ids)} неиспользуемых файлов на Google Drive пакетными запросами")
+    results = execute_drive_batch(drive_service, [drive_service.files().delete(fileId=file_id) for file_id in orphan_ids])
+    deleted_urls = set()
+    for file_id, (response, exception) in zip(orphan_ids, results):
+        if exception is not None and not is_drive_not_found(exception):
+            print(f"Ошибка при удалении файла {file_id} на Google Drive: {exception}")
+            continue
+        deleted_urls.add(f"https://drive.google.com/uc?export=view&id={file_id}")
+        report["drive_bytes"] += orphan_sizes[file_id]
+    report["drive_files"] += len(deleted_urls)
+    return deleted_urls
+
+def collect_garbage(drive_service=None, output_dir=None):
+    """
+    Сверяет текущий каталог товаров с локальными файлами и файлами на Google Drive
+    и удаляет то, на что каталог больше не ссылается: изображения удаленных товаров
+    в processed_images, устаревшие записи и файлы кэша (с учетом бюджета размера)
+    и неиспользуемые файлы в папке изображений на Google Drive.
+    
+    Returns:
+        dict: отчет - количество и объем удаленных файлов
+    """
+    if output_dir is None:
+        output_dir = create_output_dir()
+    report = {"local_files": 0, "local_bytes": 0, "cache_files": 0, "cache_bytes": 0,
+              "cache_entries": 0, "drive_files": 0, "drive_bytes": 0}
+    
+    live_ids = product_store_ids()
+    if not live_ids:
+        # Пустое хранилище скорее означает сбой, чем пустой каталог - ничего не удаляем
+        print("Хранилище товаров пусто, очистка пропущена")
+        return report
+    
+    live_urls = set()
+    with _products_lock:
+        for (image_urls,) in _products_db().execute("SELECT image_urls FROM products WHERE image_urls != ''"):
+            live_urls.update(url.strip() for url in image_urls.split("|") if url.strip())
+    with _drive_state_lock:
+        shop_images = list(_load_drive_state().get("shop_images", {}).values())
+    live_urls.update(shop_image["url"] for shop_image in shop_images if shop_image.get("url"))
+    live_paths = {os.path.normpath(url) for url in live_urls if not url.startswith(("http://", "https://"))}
+    
+    deleted_drive_urls = set()
+    if drive_service is not None:
+        try:
+            live_file_ids = {_drive_file_id(url) for url in live_urls} - {None}
+            deleted_drive_urls = _gc_drive_images(drive_service, live_file_ids, report)
+        except Exception as e:
+            print(f"Ошибка при очистке файлов на Google Drive: {e}")
+            import traceback
+            traceback.print_exc()
+    
+    _gc_processed_images(output_dir, live_ids, live_paths, report)
+    _gc_image_cache(live_urls, deleted_drive_urls, report)
+    
+    print(
+        f"Очистка завершена: удалено {report['local_files']} файлов из {output_dir} "
+        f"({report['local_bytes'] / 1024 / 1024:.1f} МБ), {report['cache_files']} файлов кэша "
+        f"({report['cache_bytes'] / 1024 / 1024:.1f} МБ) и {report['cache_entries']} записей кэша, "
+        f"{report['drive_files']} файлов на Google Drive ({report['drive_bytes'] / 1024 / 1024:.1f} МБ)"
+    )
+    return report
+
+def run_gc_if_due(drive_service=None):
+    """Запускает очистку, если с предыдущей прошло не меньше GC_INTERVAL_HOURS"""
+    with _products_lock:
+        last_gc = _store_meta_get(_products_db(), "last_gc", 0)
+    if time.time() - last_gc < GC_INTERVAL_HOURS * 3600:
+        return None
+    try:
+        report = collect_garbage(drive_service)
+    except Exception as e:
+        print(f"Ошибка при очистке устаревших файлов: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+    with _products_lock:
+        conn = _products_db()
+        _store_meta_set(conn, "last_gc", time.time())
+        conn.commit()
+    return report
+
 def job():
-    """Основная функция для запуска процесса обработки"""
+    """
+    Основная функция для запуска процесса обработки
+    
+    Returns:
+        bool: True, если обработка изменила товары или таблицу
+    """
     print(f"Начало обработки: {datetime.now()}")
+    changed = False
     
     # Сначала скачиваем актуальную версию Excel
     sync_excel_from_gdrive()
     
     if download_xml():
-        df, file_url = process_xml_with_gdrive()
-        print(f"Ссылка на обработанный документ: {file_url}")
+        if not feed_needs_processing():
+            print("XML-файл и таблица не изменились с последней обработки, цикл пропущен")
+        else:
+            df, file_url, changed = process_xml_with_gdrive()
+            print(f"Ссылка на обработанный документ: {file_url}")
+            if file_url:
+                mark_feed_processed()
+            else:
+                # Таблица не загружена - следующий цикл не будет пропущен
+                print("Таблица не загружена на Google Drive, цикл будет повторен")
+    
+    # Раз в GC_INTERVAL_HOURS удаляем файлы, на которые каталог больше не ссылается
+    try:
+        drive_service = get_drive_service()
+    except Exception as e:
+        print(f"Google Drive недоступен, очищаются только локальные файлы: {e}")
+        drive_service = None
+    run_gc_if_due(drive_service)
     print(f"Обработка завершена: {datetime.now()}")
+    return changed
+
+# Одновременно выполняется только один цикл обработки (в пределах процесса)
+_cycle_lock = threading.Lock()
+
+def run_single_flight(job_func):
+    """
+    Запускает цикл обработки, только если не выполняется другой - ни в этом
+    процессе, ни в другом (демон и ручной запуск используют общий файл блокировки).
+    Если цикл уже идет, запуск пропускается, а не ставится в очередь.
+    
+    Returns:
+        bool или None: результат job_func или None, если цикл пропущен или завершился ошибкой
+    """
+    if not _cycle_lock.acquire(blocking=False):
+        print("Предыдущий цикл обработки еще не завершен, запуск пропущен")
+        return None
+    lock_file = None
+    try:
+        lock_file = open(CYCLE_LOCK_PATH, 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("Цикл обработки выполняется другим процессом, запуск пропущен")
+                return None
+        
+        started = time.monotonic()
+        try:
+            return job_func()
+        except Exception as e:
+            print(f"Ошибка в цикле обработки: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+        finally:
+            print(f"Длительность цикла обработки: {time.monotonic() - started:.1f} с")
+    finally:
+        if lock_file is not None:
+            lock_file.close()  # Закрытие файла снимает блокировку
+        _cycle_lock.release()
+
+def next_cycle_interval(current_minutes, changed, base_minutes=CYCLE_INTERVAL_MINUTES):
+    """
+    Интервал до следующего цикла: после изменений - базовый, после цикла без
+    изменений - увеличенный в CYCLE_BACKOFF_FACTOR раз (не больше CYCLE_INTERVAL_MAX_MINUTES).
+    Пропущенный или неудачный цикл (changed is None) интервал не меняет
+    """
+    if changed is None:
+        return current_minutes
+    if changed:
+        return base_minutes
+    return min(current_minutes * CYCLE_BACKOFF_FACTOR, max(CYCLE_INTERVAL_MAX_MINUTES, base_minutes))
+
+def run_scheduler(job_func=None, base_minutes=CYCLE_INTERVAL_MINUTES):
+    """
+    Регулярный запуск циклов обработки. Следующий цикл отсчитывается от
+    окончания предыдущего, поэтому циклы не накапливаются, даже если обработка
+    длится дольше интервала; интервал подстраивается под частоту изменений XML.
+    При остановке (например, по Ctrl+C) пулы обработки и цикл событий закрываются
+    """
+    job_func = job_func or job
+    interval = base_minutes
+    try:
+        while True:
+            changed = run_single_flight(job_func)
+            interval = next_cycle_interval(interval, changed, base_minutes)
+            print(f"Следующий цикл обработки через {interval} мин")
+            time.sleep(interval * 60)
+    finally:
+        shutdown_pools()
 
 def main():
     """Основная функция для запуска скрипта"""
-    # Сначала запускаем обработку однократно
-    job()
+    # Декодируем оверлеи заранее, до первого цикла обработки
+    warm_overlay_cache()
     
-    # Настраиваем регулярное выполнение задачи (каждые 5 минут)
-    schedule.every(5).minutes.do(job)
-    
-    # Бесконечный цикл для выполнения запланированных задач
-    while True:
-        schedule.run_pending()
-        time.sleep(60)  # Проверка каждую минуту
+    # Запускаем обработку сразу и далее регулярно (базовый интервал - 5 минут)
+    run_scheduler(job)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,11 @@
+from importlib.machinery import SourceFileLoader
+
+# Загружаем модуль main.py как отдельный модуль
+main_module = SourceFileLoader("main_module", "./main.py").load_module()
+
+if __name__ == "__main__":
+    print("Запуск с асинхронным конвейером изображений...")
+    # Изображения скачиваются через aiohttp в цикле событий, наложение и загрузка на Google Drive - в пулах
+    main_module.IMAGE_PIPELINE = "async"
+    main_module.warm_overlay_cache()
+    main_module.run_scheduler(main_module.job)
\ No newline at end of file
@@ -1,13 +1,23 @@
 import time
 import schedule
 from datetime import datetime
-from main import download_xml, process_xml
+from importlib.machinery import SourceFileLoader
+
+# Загружаем модуль main.py как отдельный модуль
+main_module = SourceFileLoader("main_module", "./main.py").load_module()
+download_xml = main_module.download_xml
+process_xml = main_module.process_xml
+run_single_flight = main_module.run_single_flight
 
 def job():
+    """Запуск процесса обработки, если не выполняется другой цикл (общая с демоном блокировка)"""
+    run_single_flight(process)
+
+def process():
     """Основная функция для запуска процесса обработки"""
     print(f"Начало обработки: {datetime.now()}")
     if download_xml():
-        df, file_url = process_xml()
+        df, file_url, _ = process_xml()
         print(f"Ссылка на обработанный документ: {file_url}")
     print(f"Обработка завершена: {datetime.now()}")
 
@@ -1,6 +1,12 @@
 import os
 from datetime import datetime
-from main import process_xml, upload_to_google_drive
+from importlib.machinery import SourceFileLoader
+
+# Загружаем модуль main.py как отдельный модуль
+main_module = SourceFileLoader("main_module", "./main.py").load_module()
+process_xml = main_module.process_xml
+upload_to_google_drive = main_module.upload_to_google_drive
+run_single_flight = main_module.run_single_flight
 
 # Путь к локальному XML-файлу
 LOCAL_XML_PATH = "avito-ipkuznetsov.xml"
@@ -16,7 +22,11 @@ def run_local_process():
     
     # Запускаем обработку с имеющимся файлом
     print(f"Используем существующий XML-файл: {LOCAL_XML_PATH}")
-    df, file_url = process_xml()
+    # Общая с демоном блокировка: если идет другой цикл, запуск пропускается
+    result = run_single_flight(process_xml)
+    if result is None:
+        return
+    df, file_url, _ = result
     
     if file_url:
         print(f"Ссылка на Google-таблицу: {file_url}")
@@ -1,12 +1,23 @@
-from main import download_xml, process_xml
+from importlib.machinery import SourceFileLoader
+
+# Загружаем модуль main.py как отдельный модуль
+main_module = SourceFileLoader("main_module", "./main.py").load_module()
+download_xml = main_module.download_xml
+process_xml = main_module.process_xml
+run_single_flight = main_module.run_single_flight
 
 def run_manual_process():
     """Запуск процесса обработки вручную"""
     print("Начало ручной обработки XML-файла")
+    # Общая с демоном блокировка: если идет другой цикл, запуск пропускается
+    run_single_flight(process_downloaded_xml)
+    print("Обработка завершена")
+
+def process_downloaded_xml():
+    """Скачивание и обработка XML-файла"""
     if download_xml():
-        df, file_url = process_xml()
+        df, file_url, _ = process_xml()
         print(f"Ссылка на обработанный документ: {file_url}")
-    print("Обработка завершена")
 
 if __name__ == "__main__":
     run_manual_process() 
\ No newline at end of file
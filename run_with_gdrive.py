@@ -7,6 +7,7 @@ from importlib.machinery import SourceFileLoader
 main_module = SourceFileLoader("main_module", "./main.py").load_module()
 download_xml = main_module.download_xml
 process_xml_with_gdrive = main_module.process_xml_with_gdrive
+run_single_flight = main_module.run_single_flight
 
 def run_with_gdrive():
     """Запуск обработки XML с загрузкой изображений на Google Drive"""
@@ -19,7 +20,11 @@ def run_with_gdrive():
     # Загружаем XML-файл
     if download_xml():
         # Обрабатываем XML с загрузкой изображений на Google Drive
-        _, file_url = process_xml_with_gdrive()
+        # (общая с демоном блокировка: если идет другой цикл, запуск пропускается)
+        result = run_single_flight(process_xml_with_gdrive)
+        if result is None:
+            return False
+        _, file_url, _ = result
         print(f"Ссылка на обработанный документ: {file_url}")
         return True
     
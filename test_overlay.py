@@ -1,7 +1,9 @@
 import os
 from PIL import Image as PILImage
+import numpy as np
 import requests
 from io import BytesIO
+from importlib.machinery import SourceFileLoader
 
 def overlay_test():
     """Тест функции наложения изображений с максимальным смещением вниз"""
@@ -69,5 +71,44 @@ def overlay_test():
         traceback.print_exc()
         return None
 
+def reference_overlay(main_module, base_img, overlay_path):
+    """Прежний способ наложения (полноразмерный RGBA-холст и paste с маской) - эталон для сравнения"""
+    base_img = base_img.convert("RGBA")
+    base_width, base_height = base_img.size
+    overlay_img = main_module.get_scaled_overlay(overlay_path, base_img.size)
+    paste_x = (base_width - overlay_img.width) // 2
+    paste_y = max(base_height - overlay_img.height - int(base_height * 0.005), 0)
+    
+    result = PILImage.new("RGBA", base_img.size, (0, 0, 0, 0))
+    result.paste(base_img, (0, 0))
+    result.paste(overlay_img, (paste_x, paste_y), overlay_img)
+    return result.convert("RGB")
+
+def compositing_regression_test():
+    """Проверка, что наложение через NumPy попиксельно совпадает с прежним способом"""
+    main_module = SourceFileLoader("main_module", "./main.py").load_module()
+    
+    # Фото магазина в разных размерах и шумовое изображение (все значения каналов)
+    sources = [PILImage.open(path).convert("RGB") for path in main_module.SHOP_IMAGES if os.path.exists(path)]
+    rng = np.random.default_rng(0)
+    sources.append(PILImage.fromarray(rng.integers(0, 256, (777, 1031, 3), dtype=np.uint8), "RGB"))
+    sizes = [None, (1920, 1440), (800, 1200), (333, 251)]
+    
+    checked = 0
+    for overlay_path in main_module.OVERLAY_IMAGES:
+        for source in sources:
+            for size in sizes:
+                base_img = source if size is None else source.resize(size)
+                expected = np.asarray(reference_overlay(main_module, base_img, overlay_path))
+                actual = np.asarray(main_module.apply_overlay(base_img.copy(), overlay_path))
+                if not np.array_equal(expected, actual):
+                    diff = int(np.abs(expected.astype(int) - actual.astype(int)).max())
+                    print(f"Расхождение для {overlay_path}, размер {base_img.size}: до {diff}")
+                    return False
+                checked += 1
+    print(f"Наложение совпадает с эталоном попиксельно: {checked} изображений")
+    return True
+
 if __name__ == "__main__":
+    compositing_regression_test()
     overlay_test() 
\ No newline at end of file